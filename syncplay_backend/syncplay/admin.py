@@ -8,6 +8,9 @@ class RoomAdmin(admin.ModelAdmin):
     search_fields = ['name', 'id', 'host_id']
     readonly_fields = ['id', 'created_at', 'updated_at']
     
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_users()
+    
     def user_count(self, obj):
         return obj.user_count
     user_count.short_description = 'Users'
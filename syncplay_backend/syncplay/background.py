@@ -0,0 +1,84 @@
+import atexit
+import logging
+import threading
+
+from django.db import close_old_connections
+
+logger = logging.getLogger('syncplay')
+
+_flushers = []
+_flushers_lock = threading.Lock()
+
+
+class BackgroundFlusher:
+    """Runs a flush callable periodically on a daemon thread.
+
+    The flush callable is synchronous and may touch the database; it is also
+    run one last time when the flusher is stopped so pending state is not lost.
+    """
+
+    def __init__(self, name, interval, flush):
+        self.name = name
+        self.interval = interval
+        self.flush = flush
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._run, name=f'syncplay-{self.name}', daemon=True
+            )
+            self._thread.start()
+        with _flushers_lock:
+            if self not in _flushers:
+                _flushers.append(self)
+
+    def wake(self):
+        """Flush now instead of waiting for the next interval"""
+        self._wakeup.set()
+
+    def stop(self, timeout=10):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._stopping.set()
+            self._wakeup.set()
+            thread.join(timeout)
+        else:
+            self._flush_once()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self._flush_once()
+
+    def _flush_once(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Background flush '{self.name}' failed: {e}")
+        finally:
+            close_old_connections()
+
+
+def shutdown_flushers(timeout=10):
+    """Stop every started flusher, flushing whatever is still pending"""
+    with _flushers_lock:
+        flushers = list(_flushers)
+    for flusher in flushers:
+        flusher.stop(timeout)
+
+
+atexit.register(shutdown_flushers)
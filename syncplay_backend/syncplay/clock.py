@@ -0,0 +1,69 @@
+import math
+import time
+
+
+def server_time_ms():
+    """Server wall-clock time in milliseconds, the unit clients use on the wire"""
+    return time.time() * 1000
+
+
+def client_time_ms(value):
+    """A timestamp reported by a client, or None unless it is a finite number"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        return None
+    return value
+
+
+class ClockSync:
+    """NTP-style estimate of a client's clock offset and round-trip time.
+
+    One exchange gives four timestamps: client send (t0), server receive (t1),
+    server send (t2) and client receive (t3). The offset is how far the client
+    clock is ahead of the server clock; estimates are smoothed the same way
+    NTP smooths its samples, and jitter tracks how much the offset moves.
+    """
+
+    SMOOTHING = 0.125
+
+    def __init__(self):
+        self.offset = None
+        self.rtt = None
+        self.jitter = 0.0
+        self.samples = 0
+        self._pending = None
+
+    def begin(self, client_send, server_receive, server_send):
+        """Remember an exchange until the client reports when it received the reply"""
+        self._pending = (client_send, server_receive, server_send)
+
+    def complete(self, client_receive):
+        if self._pending is None:
+            return False
+        t0, t1, t2 = self._pending
+        self._pending = None
+        return self.add_sample(t0, t1, t2, client_receive)
+
+    def add_sample(self, t0, t1, t2, t3):
+        rtt = (t3 - t0) - (t2 - t1)
+        if rtt < 0:
+            # Clock stepped or the client mixed up exchanges
+            return False
+        offset = ((t0 - t1) + (t3 - t2)) / 2
+
+        if self.offset is None:
+            self.offset = offset
+            self.rtt = rtt
+        else:
+            self.jitter += (abs(offset - self.offset) - self.jitter) * self.SMOOTHING
+            self.offset += (offset - self.offset) * self.SMOOTHING
+            self.rtt += (rtt - self.rtt) * self.SMOOTHING
+        self.samples += 1
+        return True
+
+    def to_dict(self):
+        return {
+            'offset': self.offset,
+            'rtt': self.rtt,
+            'jitter': self.jitter,
+            'samples': self.samples,
+        }
@@ -0,0 +1,85 @@
+import json
+
+from django.conf import settings
+
+CODECS = ('auto', 'orjson', 'msgspec', 'json')
+
+
+class StdlibCodec:
+    name = 'json'
+
+    def dumps(self, obj, default=None):
+        return json.dumps(obj, default=default, separators=(',', ':'), ensure_ascii=False).encode()
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj, default=None):
+        return self._orjson.dumps(obj, default=default, option=self._orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data):
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError
+        return self._orjson.loads(data)
+
+
+class MsgspecCodec:
+    name = 'msgspec'
+
+    def __init__(self):
+        import msgspec
+        self._msgspec = msgspec
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj, default=None):
+        return self._msgspec.json.encode(obj, enc_hook=default)
+
+    def loads(self, data):
+        try:
+            return self._decoder.decode(data)
+        except self._msgspec.DecodeError as e:
+            doc = data if isinstance(data, str) else data.decode(errors='replace')
+            raise json.JSONDecodeError(str(e), doc, 0) from e
+
+
+def load_codec(name):
+    """Return the codec called `name`; 'auto' picks the fastest one installed"""
+    if name not in CODECS:
+        raise ValueError(f"Unknown JSON codec: {name}")
+    candidates = {
+        'auto': (OrjsonCodec, MsgspecCodec, StdlibCodec),
+        'orjson': (OrjsonCodec,),
+        'msgspec': (MsgspecCodec,),
+        'json': (StdlibCodec,),
+    }[name]
+    for codec_class in candidates:
+        try:
+            return codec_class()
+        except ImportError:
+            continue
+    raise ImportError(f"JSON codec '{name}' is not installed")
+
+
+codec = load_codec(getattr(settings, 'SYNCPLAY_JSON_CODEC', 'auto'))
+
+
+def dumps(obj, default=None):
+    """Encode to a JSON str, for WebSocket text frames"""
+    return codec.dumps(obj, default).decode()
+
+
+def dumps_bytes(obj, default=None):
+    """Encode to UTF-8 JSON bytes, for HTTP bodies"""
+    return codec.dumps(obj, default)
+
+
+def loads(data):
+    """Decode JSON from str or bytes; raises json.JSONDecodeError on bad input"""
+    return codec.loads(data)
@@ -1,13 +1,21 @@
 import json
 import logging
-from datetime import timedelta
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.utils import timezone
-from .models import Room, User, Message, RoomSession
+from django.conf import settings
+from . import codec, protocol
+from .repository import room_repository
+from .room_state import room_states
+from .message_log import message_log
+from .clock import ClockSync, client_time_ms, server_time_ms
+from .presence import presence
+from .metrics import metrics
+from .throttle import TokenBucket, control_rate_policy, seek_coalescer, join_batcher, join_gate
 
 logger = logging.getLogger('syncplay')
 
+# Messages that change playback and are subject to per-connection rate limits
+CONTROL_MESSAGE_TYPES = ('play', 'pause', 'seek', 'video_changed')
+
 class SyncPlayConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
@@ -15,6 +23,14 @@ class SyncPlayConsumer(AsyncWebsocketConsumer):
         self.user_id = None
         self.user = None
         self.room = None
+        self.room_state = None
+        self.clock = ClockSync()
+        self.control_bucket = TokenBucket.for_control_messages()
+        
+        # Opt-in compact protocol, negotiated through the WebSocket subprotocol
+        self.subprotocol = protocol.negotiate(self.scope.get('subprotocols'))
+        self.compact = protocol.is_compact(self.subprotocol)
+        self.deflate = protocol.is_deflate(self.subprotocol)
         
         # Join room group
         await self.channel_layer.group_add(
@@ -22,8 +38,8 @@ class SyncPlayConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
-        logger.info(f"WebSocket connected to room {self.room_id}")
+        await self.accept(subprotocol=self.subprotocol)
+        logger.info(f"WebSocket connected to room {self.room_id} ({self.subprotocol or 'json'})")
 
     async def disconnect(self, close_code):
         # Leave room group
@@ -39,15 +55,31 @@ class SyncPlayConsumer(AsyncWebsocketConsumer):
         # Remove session
         await self.remove_session()
         
+        # Let the room state be dropped once its pending changes are flushed
+        if self.room_state:
+            await room_states.release(self.room_id, self.channel_name)
+            self.room_state = None
+        
         logger.info(f"WebSocket disconnected from room {self.room_id}")
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        received_at = server_time_ms()
         try:
-            logger.info(f"🔥 BACKEND RECEIVED: {text_data}")
-            data = json.loads(text_data)
+            if text_data is not None:
+                logger.info(f"🔥 BACKEND RECEIVED: {text_data}")
+            data = protocol.decode(self.subprotocol, text_data, bytes_data)
             message_type = data.get('type')
             logger.info(f"🔥 MESSAGE TYPE: {message_type}, DATA: {data}")
             
+            if message_type in CONTROL_MESSAGE_TYPES and not self.control_bucket.consume():
+                await self.handle_rate_limited(message_type)
+                return
+            
+            # Playback state is keyed by the URL's room; only members change it
+            if message_type in CONTROL_MESSAGE_TYPES and not self.room_state:
+                await self.send_error("Join the room first")
+                return
+            
             if message_type == 'join':
                 await self.handle_join(data)
             elif message_type == 'play':
@@ -61,7 +93,9 @@ class SyncPlayConsumer(AsyncWebsocketConsumer):
             elif message_type == 'video_changed':
                 await self.handle_video_change(data)
             elif message_type == 'heartbeat':
-                await self.handle_heartbeat(data)
+                await self.handle_heartbeat(data, received_at)
+            elif message_type == 'sync':
+                await self.handle_sync(data)
             else:
                 logger.error(f"❌ Unknown message type: {message_type}")
                 await self.send_error(f"Unknown message type: {message_type}")
@@ -69,6 +103,9 @@ class SyncPlayConsumer(AsyncWebsocketConsumer):
         except json.JSONDecodeError:
             logger.error(f"❌ Invalid JSON format: {text_data}")
             await self.send_error("Invalid JSON format")
+        except protocol.ProtocolError as e:
+            logger.error(f"❌ Invalid compact frame: {e}")
+            await self.send_error("Invalid message format")
         except Exception as e:
             logger.error(f"❌ Error processing message: {e}")
             await self.send_error("Internal server error")
@@ -84,49 +121,37 @@ class SyncPlayConsumer(AsyncWebsocketConsumer):
             return
         
         try:
-            # Get or create room
-            self.room = await self.get_room(self.room_id)
-            if not self.room:
-                await self.send_error("Room not found")
+            # Room, user and session in one round trip, a few joins per room at a time
+            # Only clients that negotiated a subprotocol know join_queued
+            on_queued = self.send_join_queued if self.subprotocol else None
+            async with join_gate.slot(self.room_id, on_queued):
+                room, user, room_data = await room_repository.join(
+                    self.room_id, self.channel_name, user_id, user_name
+                )
+            if not room:
+                await self.send_error(room_data)
                 return
+            presence.touch(self.channel_name, self.room_id)
+            self.room = room
+            self.user = user
+            self.user_id = str(user.id)
             
-            existing_user_by_id = await self.get_user_by_id(self.room, user_id)
-            
-            if existing_user_by_id:
-                self.user = existing_user_by_id
-                self.user_id = user_id
-            else:
-                # Check if user name is already taken
-                existing_user = await self.get_user_by_name(self.room, user_name)
-                if existing_user:
-                    await self.send_error("User name already taken")
-                    return
-                
-                # Create user
-                self.user = await self.create_user(self.room, user_id, user_name)
-                self.user_id = user_id
-            
-            # Create session
-            await self.create_session()
+            if not self.room_state:
+                self.room_state = await room_states.acquire(self.room, self.channel_name)
             
             # Store message
-            await self.store_message('join', {'userName': user_name})
+            self.store_message('join', {'userName': user_name})
             
-            # Notify others about new user
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_joined',
-                    'user': await self.user_to_dict(self.user),
-                    'room': await self.room_to_dict(self.room)
-                }
-            )
+            # Notify others about new user, reusing the joiner's snapshot;
+            # joins arriving together are announced together
+            user_data = next(u for u in room_data['users'] if u['id'] == str(user.id))
+            await join_batcher.submit(self.room_id, user_data, self.broadcast_joins)
             
             # Send room state to the new user
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'room_update',
-                'data': await self.room_to_dict(self.room)
-            }))
+                'data': await self.room_snapshot(self.room, room_data)
+            })
             
             logger.info(f"User {user_name} joined room {self.room_id}")
             
@@ -134,6 +159,28 @@ class SyncPlayConsumer(AsyncWebsocketConsumer):
             logger.error(f"Error joining room: {e}")
             await self.send_error("Failed to join room")
 
+    async def send_join_queued(self, position):
+        await self.send_message({
+            'type': 'join_queued',
+            'data': {'position': position}
+        })
+
+    async def broadcast_joins(self, users):
+        version = await room_states.bump(self.room_id)
+        if len(users) == 1:
+            await self.broadcast({'type': 'user_joined', 'data': users[0]}, version=version)
+            return
+        # The original JSON clients only know user_joined: they get one per user
+        singles = [{'type': 'user_joined', 'data': user} for user in users]
+        if version is not None:
+            for message in singles:
+                message['version'] = version
+        await self.broadcast(
+            {'type': 'users_joined', 'data': {'users': users}},
+            version=version,
+            legacy_frames=[codec.dumps(message) for message in singles]
+        )
+
     async def handle_play(self, data):
         logger.info(f"🎬 PLAY HANDLER - user_id: {self.user_id}, room: {self.room_id}")
         
@@ -143,25 +190,24 @@ class SyncPlayConsumer(AsyncWebsocketConsumer):
         
         # Fix data parsing to match Flutter message format
         position = data['data'].get('position', 0)
+        playback_rate = data['data'].get('playbackRate')
         logger.info(f"🎬 PLAY position extracted: {position}")
         
-        # Update room state
-        await self.update_room_playback(True, position)
+        # Update room state (this position supersedes any pending seek)
+        seek_coalescer.cancel(self.room_id)
+        state = await self.update_room_playback(True, position, playback_rate)
         logger.info(f"🎬 Room state updated to playing")
+        await self.acknowledge(state)
         
         # Store message
-        await self.store_message('play', {'position': position})
+        self.store_message('play', {'position': position})
         
         # Broadcast to all users
         logger.info(f"🎬 Broadcasting PLAY to group: {self.room_group_name}")
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'video_play',
-                'position': position,
-                'user_id': self.user_id
-            }
-        )
+        await self.broadcast({
+            'type': 'play',
+            'data': self.playback_data(position)
+        }, exclude_sender=True, version=state and state.version)
         logger.info(f"🎬 PLAY broadcast completed")
 
     async def handle_pause(self, data):
@@ -170,21 +216,19 @@ class SyncPlayConsumer(AsyncWebsocketConsumer):
         
         # Fix data parsing to match Flutter message format
         position = data['data'].get('position', 0)
-        # Update room state
-        await self.update_room_playback(False, position)
+        # Update room state (this position supersedes any pending seek)
+        seek_coalescer.cancel(self.room_id)
+        state = await self.update_room_playback(False, position)
+        await self.acknowledge(state)
         
         # Store message
-        await self.store_message('pause', {'position': position})
+        self.store_message('pause', {'position': position})
         
         # Broadcast to all users
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'video_pause',
-                'position': position,
-                'user_id': self.user_id
-            }
-        )
+        await self.broadcast({
+            'type': 'pause',
+            'data': self.playback_data(position)
+        }, exclude_sender=True, version=state and state.version)
 
     async def handle_seek(self, data):
         # if not await self.check_host_permission():
@@ -194,21 +238,25 @@ class SyncPlayConsumer(AsyncWebsocketConsumer):
         print("DATA FOR SEEK:", data)
         position = data['data'].get('position', 0)
         
-        # Update room position
-        await self.update_room_position(position)
-        
-        # Store message
-        await self.store_message('seek', {'position': position})
-        
-        # Broadcast to all users
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'video_seek',
-                'position': position,
-                'user_id': self.user_id
-            }
-        )
+        # Scrubbing sends many seeks; only the last one in a short window is applied
+        await seek_coalescer.submit(self.room_id, position, self.apply_seek)
+
+    async def apply_seek(self, position):
+        try:
+            # Update room position
+            state = await self.update_room_position(position)
+            await self.acknowledge(state)
+            
+            # Store message
+            self.store_message('seek', {'position': position})
+            
+            # Broadcast to all users
+            await self.broadcast({
+                'type': 'seek',
+                'data': self.playback_data(position)
+            }, exclude_sender=True, version=state and state.version)
+        except Exception as e:
+            logger.error(f"❌ Error applying seek: {e}")
 
     async def handle_video_change(self, data):
         if not await self.check_host_permission():
@@ -219,211 +267,204 @@ class SyncPlayConsumer(AsyncWebsocketConsumer):
         video_title = data.get('videoTitle')
         
         # Update room video
-        await self.update_room_video(video_url, video_title)
+        seek_coalescer.cancel(self.room_id)
+        state = await self.update_room_video(video_url, video_title)
+        await self.acknowledge(state)
         
         # Store message
-        await self.store_message('video_changed', {
+        self.store_message('video_changed', {
             'videoUrl': video_url,
             'videoTitle': video_title
         })
         
         # Broadcast to all users
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'video_changed',
-                'video_url': video_url,
-                'video_title': video_title,
-                'user_id': self.user_id
+        await self.broadcast({
+            'type': 'video_changed',
+            'data': {
+                'videoUrl': video_url,
+                'videoTitle': video_title,
+                'serverTime': server_time_ms()
             }
-        )
-
-    async def handle_heartbeat(self, data):
-        # Update last activity
-        await self.update_session_activity()
+        }, exclude_sender=True, version=state and state.version)
+
+    async def handle_heartbeat(self, data, received_at):
+        # Clock sync: the client sends its send time (ms) and, from the second
+        # beat on, when it received our previous reply; anything but a number
+        # is ignored
+        beat = data.get('data') or {}
+        client_send = client_time_ms(beat.get('clientSendTime', beat.get('timestamp')))
+        last_receive = client_time_ms(beat.get('lastReceiveTime'))
+        if last_receive is not None and self.clock.complete(last_receive):
+            logger.debug(f"Clock sync for {self.user_id}: {self.clock.to_dict()}")
+        
+        # Update last activity (persisted by the periodic presence sweep)
+        presence.touch(self.channel_name, self.room_id)
         
         # Send heartbeat response
-        await self.send(text_data=json.dumps({
+        sent_at = server_time_ms()
+        if client_send is not None:
+            self.clock.begin(client_send, received_at, sent_at)
+        await self.send_message({
             'type': 'heartbeat',
-            'data': {'timestamp': timezone.now().timestamp()}
-        }))
+            'data': {
+                'timestamp': sent_at / 1000,
+                'clientSendTime': client_send,
+                'serverReceiveTime': received_at,
+                'serverSendTime': sent_at,
+                'clock': self.clock.to_dict(),
+            }
+        })
+
+    async def handle_rate_limited(self, message_type):
+        metrics.incr('ws.rate_limited')
+        logger.warning(f"Rate limited {message_type} from {self.user_id} in room {self.room_id} ({control_rate_policy})")
+        if control_rate_policy == 'close':
+            await self.close(code=4008)
+        elif control_rate_policy == 'error':
+            await self.send_error("Rate limit exceeded")
+
+    async def acknowledge(self, state):
+        # The sender is left out of its own broadcast; without the version it
+        # would see a gap on the next delta and ask for a snapshot
+        if state and self.subprotocol:
+            await self.send_message({'type': 'sync', 'data': {'version': state.version}})
+
+    async def handle_sync(self, data):
+        # Clients track the version carried by every delta (play, seek,
+        # user_joined, ...) and ask for a snapshot when they notice a gap
+        state = await room_states.get(self.room_id)
+        if not self.room or not state:
+            await self.send_error("Join the room before syncing")
+            return
+        
+        if (data.get('data') or {}).get('version') == state.version:
+            await self.send_message({'type': 'sync', 'data': {'version': state.version}})
+        else:
+            await self.send_message({
+                'type': 'room_update',
+                'data': await self.room_snapshot(self.room)
+            })
 
     async def handle_user_leave(self):
         if self.user:
             # Remove user from room
-            await self.remove_user()
+            await room_repository.remove_user(self.user)
             
             # Store message
-            await self.store_message('leave', {})
+            self.store_message('leave', {})
             
             # Notify others
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_left',
-                    'user_id': self.user_id,
-                    'room': await self.room_to_dict(self.room)
-                }
-            )
+            await self.broadcast({
+                'type': 'user_left',
+                'data': {'user_id': self.user_id}
+            }, version=await room_states.bump(self.room_id))
 
     # Group message handlers
-    async def user_joined(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_joined',
-            'data': event['user']
-        }))
-
-    async def user_left(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_left',
-            'data': {'user_id': event['user_id']}
-        }))
-
-    async def video_play(self, event):
-        logger.info(f"🎬 VIDEO_PLAY event received - sender: {event['user_id']}, receiver: {self.user_id}")
-        if event['user_id'] != self.user_id:  # Don't send back to sender
-            message = {
-                'type': 'play',
-                'data': {'position': event['position']}
-            }
-            logger.info(f"🎬 Sending PLAY to client: {message}")
-            await self.send(text_data=json.dumps(message))
+    async def broadcast_frame(self, event):
+        # The sender encoded the JSON frame once; other variants are built on
+        # first use and shared by every receiver on this worker
+        if event['exclude_sender'] and event['user_id'] == self.user_id:
+            return
+        if event.get('legacy_frames') and not self.subprotocol:
+            for frame in event['legacy_frames']:
+                await self.send_frame(frame)
+            return
+        text = event['text']
+        plain = protocol.encode_frame(text, protocol.COMPACT_PROTOCOL) if self.compact else text
+        await self.send_frame(plain, protocol.encode_frame(text, self.subprotocol) if self.deflate else None)
+
+    # Helper methods
+    async def broadcast(self, message, exclude_sender=False, version=None, legacy_frames=None):
+        """Send a message to the whole room, serialized once for all receivers.
+
+        `legacy_frames` replace the message for connections without a
+        subprotocol, for message types the original JSON protocol lacks.
+        """
+        if version is not None:
+            message['version'] = version
+        event = {
+            'type': 'broadcast_frame',
+            'text': codec.dumps(message),
+            'user_id': self.user_id,
+            'exclude_sender': exclude_sender
+        }
+        if legacy_frames:
+            event['legacy_frames'] = legacy_frames
+        await self.channel_layer.group_send(self.room_group_name, event)
+
+    def playback_data(self, position):
+        # serverTime lets clients place the command on their own clock using
+        # the offset learned from heartbeats
+        server_time = server_time_ms()
+        data = {'position': position, 'serverTime': server_time}
+        lead = getattr(settings, 'SYNCPLAY_SCHEDULE_LEAD_MS', 0)
+        if lead:
+            data['executeAt'] = server_time + lead
+        return data
+
+    async def send_message(self, message):
+        if self.compact:
+            frame = protocol.encode_compact(message)
         else:
-            logger.info(f"🎬 Skipping PLAY send to sender")
-
-    async def video_pause(self, event):
-        logger.info(f"⏸️ VIDEO_PAUSE event received - sender: {event['user_id']}, receiver: {self.user_id}")
-        if event['user_id'] != self.user_id:  # Don't send back to sender
-            message = {
-                'type': 'pause',
-                'data': {'position': event['position']}
-            }
-            logger.info(f"⏸️ Sending PAUSE to client: {message}")
-            await self.send(text_data=json.dumps(message))
+            frame = codec.dumps(message)
+        await self.send_frame(frame, protocol.compress(frame) if self.deflate else None)
+
+    async def send_frame(self, frame, deflated=None):
+        if deflated is not None:
+            size = len(frame) if isinstance(frame, bytes) else len(frame.encode())
+            metrics.incr('ws.compression.frames')
+            metrics.incr('ws.compression.bytes_in', size)
+            metrics.incr('ws.compression.bytes_out', len(deflated))
+            await self.send(bytes_data=deflated)
+        elif isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
         else:
-            logger.info(f"⏸️ Skipping PAUSE send to sender")
+            await self.send(text_data=frame)
 
-    async def video_seek(self, event):
-        if event['user_id'] != self.user_id:  # Don't send back to sender
-            await self.send(text_data=json.dumps({
-                'type': 'seek',
-                'data': {'position': event['position']}
-            }))
-
-    async def video_changed(self, event):
-        if event['user_id'] != self.user_id:  # Don't send back to sender
-            await self.send(text_data=json.dumps({
-                'type': 'video_changed',
-                'data': {
-                    'videoUrl': event['video_url'],
-                    'videoTitle': event['video_title']
-                }
-            }))
-
-    # Helper methods
     async def send_error(self, message):
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'error',
             'data': {'error': message}
-        }))
+        })
 
     async def check_host_permission(self):
-        if not self.user or not await self.is_user_host(self.user):
+        if not self.user or not self.user.is_host:
             await self.send_error("Only the host can control playback")
             return False
         return True
 
-    # Database operations
-    @database_sync_to_async
-    def get_room(self, room_id):
-        try:
-            return Room.objects.get(id=room_id)
-        except Room.DoesNotExist:
-            return None
-
-    @database_sync_to_async
-    def get_user_by_name(self, room, name):
-        try:
-            return User.objects.get(room=room, name=name)
-        except User.DoesNotExist:
-            return None
-
-    @database_sync_to_async
-    def get_user_by_id(self, room, name):
-        try:
-            return User.objects.get(room=room, id=name)
-        except User.DoesNotExist:
-            return None
-
-    @database_sync_to_async
-    def create_user(self, room, user_id, name):
-        is_host = not room.users.exists()  # First user becomes host
-        return User.objects.create(
-            id=user_id,
-            room=room,
-            name=name,
-            is_host=is_host
+    # Room state operations (shared state, written behind by room_states)
+    async def update_room_playback(self, is_playing, position, playback_rate=None):
+        changes = {'is_playing': is_playing, 'position': float(position)}
+        if playback_rate:
+            changes['playback_rate'] = float(playback_rate)
+        return await room_states.update(self.room_id, **changes)
+
+    async def update_room_position(self, position):
+        return await room_states.update(self.room_id, position=float(position))
+
+    async def update_room_video(self, video_url, video_title):
+        return await room_states.update(
+            self.room_id,
+            video_url=video_url,
+            video_title=video_title,
+            position=0.0,
+            is_playing=False
         )
 
-    @database_sync_to_async
-    def remove_user(self):
-        if self.user:
-            self.user.delete()
-
-    @database_sync_to_async
-    def is_user_host(self, user):
-        return user.is_host
-
-    @database_sync_to_async
-    def update_room_playback(self, is_playing, position):
-        self.room.is_playing = is_playing
-        self.room.current_position = timedelta(seconds=position)
-        self.room.save()
-
-    @database_sync_to_async
-    def update_room_position(self, position):
-        self.room.current_position = timedelta(seconds=position)
-        self.room.save()
-
-    @database_sync_to_async
-    def update_room_video(self, video_url, video_title):
-        self.room.current_video_url = video_url
-        self.room.current_video_title = video_title
-        self.room.current_position = timedelta(0)
-        self.room.is_playing = False
-        self.room.save()
-
-    @database_sync_to_async
     def store_message(self, message_type, data):
-        return Message.objects.create(
-            room=self.room,
-            user_id=self.user_id,
-            message_type=message_type,
-            data=data
-        )
-
-    @database_sync_to_async
-    def create_session(self):
-        return RoomSession.objects.create(
-            room=self.room,
-            user_id=self.user_id,
-            channel_name=self.channel_name
-        )
-
-    @database_sync_to_async
-    def remove_session(self):
-        RoomSession.objects.filter(channel_name=self.channel_name).delete()
-
-    @database_sync_to_async
-    def update_session_activity(self):
-        RoomSession.objects.filter(channel_name=self.channel_name).update(
-            last_activity=timezone.now()
-        )
-
-    @database_sync_to_async
-    def room_to_dict(self, room):
-        return room.to_dict()
-
-    @database_sync_to_async
-    def user_to_dict(self, user):
-        return user.to_dict() 
+        # Queued for a batched insert, never blocks the broadcast
+        message_log.log(self.room.id, self.user_id, message_type, data)
+
+    async def remove_session(self):
+        presence.forget(self.channel_name)
+        await room_repository.remove_session(self.channel_name)
+
+    async def room_snapshot(self, room, data=None):
+        if data is None:
+            data = await room_repository.room_to_dict(room)
+        # The shared state is ahead of the row until the next flush
+        state = await room_states.get(room.id)
+        if state:
+            data.update(state.to_dict())
+        return data
@@ -0,0 +1,76 @@
+"""Database work for the WebSocket consumers, on its own bounded thread pool.
+
+channels' database_sync_to_async runs on asgiref's default executor, shared
+with every other sync_to_async call, and each of its threads may hold a
+database connection. Here database calls get a dedicated pool of
+SYNCPLAY_DB_THREADS threads, which also caps the connections the process
+opens. Those long-lived threads reuse their connection for
+SYNCPLAY_DB_CONN_MAX_AGE seconds, whatever CONN_MAX_AGE says: that one
+stays 0 for the ASGI request threads, which never run twice.
+"""
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import connection
+
+from .metrics import metrics
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                threads = getattr(settings, 'SYNCPLAY_DB_THREADS', 8)
+                if connection.vendor == 'sqlite':
+                    # One writer at a time; concurrent transactions fail with "database is locked"
+                    threads = 1
+                _executor = ThreadPoolExecutor(
+                    max_workers=threads,
+                    thread_name_prefix='syncplay-db',
+                )
+    return _executor
+
+
+def keep_connection():
+    """Give a connection opened on a pool thread the pool's own max age.
+
+    Django sets close_at from CONN_MAX_AGE when it connects; it is only
+    pushed out once per connection, so the age still counts from the connect.
+    """
+    if connection.connection is None or getattr(connection, 'pool_connection', None) is connection.connection:
+        return
+    connection.pool_connection = connection.connection
+    max_age = getattr(settings, 'SYNCPLAY_DB_CONN_MAX_AGE', 60)
+    connection.close_at = None if max_age is None else time.monotonic() + max_age
+
+
+def database_sync_to_async(func):
+    """Drop-in replacement for channels' decorator that runs on the database pool.
+
+    Records how long each call waited for a thread (db.queue_wait) and how
+    long it ran (db.run_time), in seconds.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        submitted = time.monotonic()
+
+        def timed():
+            started = time.monotonic()
+            metrics.observe('db.queue_wait', started - submitted)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.observe('db.run_time', time.monotonic() - started)
+                # Before DatabaseSyncToAsync closes obsolete connections
+                keep_connection()
+
+        return await DatabaseSyncToAsync(timed, thread_sensitive=False, executor=get_executor())()
+    return wrapper
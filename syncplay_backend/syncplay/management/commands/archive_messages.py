@@ -0,0 +1,108 @@
+import gzip
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from syncplay import codec
+from syncplay.models import Message
+
+
+def retention_days(message_type):
+    retention = getattr(settings, 'SYNCPLAY_MESSAGE_RETENTION', {})
+    return retention.get(message_type, getattr(settings, 'SYNCPLAY_MESSAGE_RETENTION_DAYS', 30))
+
+
+class Command(BaseCommand):
+    help = 'Archive and delete messages older than their retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--archive-dir',
+            default=getattr(settings, 'SYNCPLAY_MESSAGE_ARCHIVE_DIR', ''),
+            help='Directory for gzipped NDJSON archives (default: SYNCPLAY_MESSAGE_ARCHIVE_DIR)',
+        )
+        parser.add_argument(
+            '--no-archive',
+            action='store_true',
+            help='Delete expired messages without archiving them',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Messages archived and deleted per batch (default: 5000)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show what would be archived without changing anything',
+        )
+
+    def handle(self, *args, **options):
+        archive_dir = None if options['no_archive'] else options['archive_dir']
+        if archive_dir:
+            os.makedirs(archive_dir, exist_ok=True)
+        now = timezone.now()
+
+        total = 0
+        for message_type, _ in Message.MESSAGE_TYPES:
+            days = retention_days(message_type)
+            if days is None or days < 0:
+                continue
+            expired = Message.objects.filter(message_type=message_type, timestamp__lt=now - timedelta(days=days))
+
+            if options['dry_run']:
+                count = expired.count()
+                if count:
+                    self.stdout.write(f"Would archive {count} '{message_type}' messages older than {days} days")
+                continue
+
+            path = None
+            if archive_dir:
+                path = os.path.join(archive_dir, f"messages-{message_type}-{now:%Y%m%d-%H%M%S}.ndjson.gz")
+            count = self.archive(expired, path, options['batch_size'])
+            if count:
+                total += count
+                self.stdout.write(
+                    f"Archived {count} '{message_type}' messages older than {days} days"
+                    + (f" to {path}" if path else "")
+                )
+
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Successfully archived {total} messages"))
+
+    def archive(self, expired, path, batch_size):
+        """Move `expired` out in batches, oldest first. Each batch is on disk before it is deleted."""
+        archive = gzip.open(path, 'at', encoding='utf-8') if path else None
+        count = 0
+        try:
+            while True:
+                batch = list(
+                    expired.order_by('timestamp', 'id')
+                    .values('id', 'room_id', 'user_id', 'message_type', 'data', 'timestamp')[:batch_size]
+                )
+                if not batch:
+                    break
+                if archive:
+                    for message in batch:
+                        archive.write(codec.dumps({
+                            'id': str(message['id']),
+                            'room_id': str(message['room_id']),
+                            'user_id': str(message['user_id']),
+                            'type': message['message_type'],
+                            'data': message['data'],
+                            'timestamp': message['timestamp'].isoformat(),
+                        }) + '\n')
+                    archive.flush()
+                # Messages have nothing depending on them: a single DELETE per batch
+                Message.objects.filter(id__in=[message['id'] for message in batch]).delete()
+                count += len(batch)
+        finally:
+            if archive:
+                archive.close()
+                if not count:
+                    os.remove(path)
+        return count
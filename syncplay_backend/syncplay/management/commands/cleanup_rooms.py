@@ -1,7 +1,35 @@
+import time
+from datetime import timedelta
+
 from django.core.management.base import BaseCommand
+from django.db import router, transaction
 from django.utils import timezone
-from datetime import timedelta
-from syncplay.models import Room, User, RoomSession
+
+from syncplay.models import Room, User, Message, RoomSession
+from syncplay.presence import presence
+from syncplay import room_cache
+
+
+def raw_delete(queryset):
+    """Single DELETE statement, skipping the collector; callers handle cascades"""
+    return queryset._raw_delete(router.db_for_write(queryset.model))
+
+
+def stale_rooms(cutoff, live_rooms=()):
+    """Rooms nobody has used since `cutoff`, empty or not; last_active_at
+    is kept current by playback writes and presence sweeps"""
+    return Room.objects.filter(
+        created_at__lt=cutoff,
+        last_active_at__lt=cutoff
+    ).exclude(id__in=live_rooms)
+
+
+def old_sessions(cutoff, live_channels=()):
+    """Sessions with no heartbeat since `cutoff` that presence doesn't know about"""
+    return RoomSession.objects.filter(
+        last_activity__lt=cutoff
+    ).exclude(channel_name__in=live_channels)
+
 
 class Command(BaseCommand):
     help = 'Clean up old empty rooms and inactive users'
@@ -18,64 +46,136 @@ class Command(BaseCommand):
             action='store_true',
             help='Show what would be deleted without actually deleting',
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Rooms or sessions deleted per transaction to start with (default: 500)',
+        )
+        parser.add_argument(
+            '--batch-budget',
+            type=float,
+            default=0.5,
+            help='Target seconds per batch; the batch size adapts to it (default: 0.5)',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.05,
+            help='Seconds to sleep between batches so other writers get the tables (default: 0.05)',
+        )
+        parser.add_argument(
+            '--continuous',
+            action='store_true',
+            help='Keep running, starting a new pass every --interval seconds',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=300,
+            help='Seconds between passes with --continuous (default: 300)',
+        )
 
     def handle(self, *args, **options):
-        hours = options['hours']
-        dry_run = options['dry_run']
+        self.batch_size = self.max_batch_size = options['batch_size']
+        self.batch_budget = options['batch_budget']
+        self.pause = options['pause']
+
+        while True:
+            self.run_pass(options['hours'], options['dry_run'])
+            if not options['continuous']:
+                break
+            try:
+                time.sleep(options['interval'])
+            except KeyboardInterrupt:
+                break
+
+        if not options['continuous']:
+            self.stdout.write(f"\nCurrent stats:")
+            self.stdout.write(f"- Active rooms: {Room.objects.count()}")
+            self.stdout.write(f"- Active users: {User.objects.count()}")
+            self.stdout.write(f"- Active sessions: {RoomSession.objects.count()}")
+
+    def run_pass(self, hours, dry_run):
         cutoff_time = timezone.now() - timedelta(hours=hours)
-        
+
         self.stdout.write(f"Cleaning up rooms older than {hours} hours...")
-        
-        # Find empty rooms older than cutoff time
-        empty_rooms = Room.objects.filter(
-            created_at__lt=cutoff_time,
-            users__isnull=True
-        )
-        
-        # Find rooms with only inactive users
-        inactive_rooms = Room.objects.filter(
-            created_at__lt=cutoff_time,
-            users__last_seen__lt=cutoff_time
-        ).distinct()
-        
-        # Clean up old sessions
-        old_sessions = RoomSession.objects.filter(
-            last_activity__lt=cutoff_time
-        )
-        
+
+        # Heartbeats reach the database only on presence sweeps; Redis (when
+        # configured) knows about sessions seen since the last one
+        live_rooms = presence.active_room_ids(cutoff_time)
+        live_channels = presence.active_channels(cutoff_time)
+
+        rooms = stale_rooms(cutoff_time, live_rooms)
+        sessions = old_sessions(cutoff_time, live_channels)
+
         if dry_run:
             self.stdout.write("DRY RUN - No actual deletions will be performed")
-            self.stdout.write(f"Would delete {empty_rooms.count()} empty rooms")
-            self.stdout.write(f"Would delete {inactive_rooms.count()} inactive rooms")
-            self.stdout.write(f"Would delete {old_sessions.count()} old sessions")
-        else:
-            # Delete old sessions first
-            sessions_deleted = old_sessions.count()
-            old_sessions.delete()
-            
-            # Delete inactive rooms (this will cascade delete users)
-            inactive_deleted = inactive_rooms.count()
-            inactive_rooms.delete()
-            
-            # Delete empty rooms
-            empty_deleted = empty_rooms.count()
-            empty_rooms.delete()
-            
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f'Successfully cleaned up:'
-                    f'\n- {empty_deleted} empty rooms'
-                    f'\n- {inactive_deleted} inactive rooms'
-                    f'\n- {sessions_deleted} old sessions'
+            self.stdout.write(f"Would delete {rooms.count()} inactive rooms")
+            self.stdout.write(f"Would delete {sessions.count()} old sessions")
+            return
+
+        # Sessions first: they are what keeps a room alive
+        sessions_deleted = self.delete_in_batches('sessions', sessions, self.delete_sessions)
+        rooms_deleted = self.delete_in_batches('rooms', rooms, self.delete_rooms)
+
+        presence.prune(cutoff_time)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Successfully cleaned up:'
+                f'\n- {rooms_deleted} inactive rooms'
+                f'\n- {sessions_deleted} old sessions'
+            )
+        )
+
+    def delete_in_batches(self, label, queryset, delete_batch):
+        """Delete `queryset` a batch of primary keys at a time, one short transaction each"""
+        total = 0
+        started = time.monotonic()
+        while True:
+            batch_size = self.batch_size
+            batch_started = time.monotonic()
+            with transaction.atomic():
+                # Lock the batch so rows that come back to life wait for us
+                # instead of being deleted halfway; rows locked by a writer
+                # are skipped until the next pass
+                ids = list(
+                    queryset.select_for_update(skip_locked=True)
+                    .order_by('pk').values_list('pk', flat=True)[:batch_size]
                 )
+                if not ids:
+                    break
+                delete_batch(ids)
+            total += len(ids)
+
+            elapsed = time.monotonic() - batch_started
+            self.stdout.write(
+                f"  Deleted {len(ids)} {label} in {elapsed:.2f}s "
+                f"({total} so far, {total / max(time.monotonic() - started, 1e-6):.0f}/s)"
             )
-        
-        # Show current stats
-        current_rooms = Room.objects.count()
-        current_users = User.objects.count()
-        current_sessions = RoomSession.objects.count()
-        
-        self.stdout.write(f"\nCurrent stats:")
-        self.stdout.write(f"- Active rooms: {current_rooms}")
-        self.stdout.write(f"- Active users: {current_users}")
-        self.stdout.write(f"- Active sessions: {current_sessions}") 
\ No newline at end of file
+            self.adapt_batch_size(elapsed)
+            if len(ids) < batch_size:
+                break
+            time.sleep(self.pause)
+        return total
+
+    def adapt_batch_size(self, elapsed):
+        # Halve batches that overrun the budget, grow them back when cheap
+        if elapsed > self.batch_budget:
+            self.batch_size = max(1, self.batch_size // 2)
+        elif elapsed < self.batch_budget / 2:
+            self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+
+    def delete_sessions(self, ids):
+        # Nothing references a session
+        raw_delete(RoomSession.objects.filter(pk__in=ids))
+
+    def delete_rooms(self, ids):
+        # Cascade by hand, children first: one DELETE per table instead of
+        # loading every user and message into the collector
+        raw_delete(Message.objects.filter(room_id__in=ids))
+        raw_delete(RoomSession.objects.filter(room_id__in=ids))
+        raw_delete(User.objects.filter(room_id__in=ids))
+        raw_delete(Room.objects.filter(pk__in=ids))
+        room_cache.invalidate(*ids)
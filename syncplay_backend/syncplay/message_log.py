@@ -0,0 +1,102 @@
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.utils import timezone
+
+from .background import BackgroundFlusher
+from .models import Room, Message
+
+logger = logging.getLogger('syncplay')
+
+
+class MessageLog:
+    """Bounded in-memory queue of Message rows written in batches with bulk_create.
+
+    Logging an event never touches the database. When the queue is full the
+    overflow policy decides what is lost: 'drop_oldest' keeps the most recent
+    events, 'drop_newest' keeps the backlog and rejects new ones.
+    """
+
+    POLICIES = ('drop_oldest', 'drop_newest')
+
+    def __init__(self, max_size=None, batch_size=None, flush_interval=None, policy=None):
+        self.max_size = max_size or getattr(settings, 'SYNCPLAY_MESSAGE_LOG_MAX_SIZE', 10000)
+        self.batch_size = batch_size or getattr(settings, 'SYNCPLAY_MESSAGE_LOG_BATCH_SIZE', 500)
+        self.policy = policy or getattr(settings, 'SYNCPLAY_MESSAGE_LOG_POLICY', 'drop_oldest')
+        if self.policy not in self.POLICIES:
+            raise ValueError(f"Unknown message log policy: {self.policy}")
+        if flush_interval is None:
+            flush_interval = getattr(settings, 'SYNCPLAY_MESSAGE_LOG_FLUSH_INTERVAL', 1.0)
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self.flusher = BackgroundFlusher('message-log', flush_interval, self.flush)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def log(self, room_id, user_id, message_type, data):
+        message = Message(
+            room_id=room_id,
+            user_id=user_id,
+            message_type=message_type,
+            data=data,
+            timestamp=timezone.now(),
+        )
+        with self._lock:
+            if len(self._queue) >= self.max_size:
+                self.dropped += 1
+                if self.policy == 'drop_newest':
+                    return False
+                self._queue.popleft()
+            self._queue.append(message)
+            size = len(self._queue)
+
+        self.flusher.start()
+        if size >= self.batch_size:
+            self.flusher.wake()
+        return True
+
+    def flush(self):
+        while True:
+            with self._lock:
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                logger.warning(f"Message log full, dropped {dropped} messages ({self.policy})")
+            if not batch:
+                return
+
+            try:
+                # Rooms may have been deleted while their messages were queued
+                room_ids = {message.room_id for message in batch}
+                existing = {str(pk) for pk in Room.objects.filter(id__in=room_ids).values_list('id', flat=True)}
+                Message.objects.bulk_create([message for message in batch if str(message.room_id) in existing])
+            except Exception:
+                self._requeue(batch)
+                raise
+
+    def _requeue(self, batch):
+        """Put a batch that failed to write back at the head of the queue.
+
+        Messages logged since it was taken count against the bound too; the
+        overflow policy decides which side loses when they don't all fit.
+        """
+        with self._lock:
+            overflow = len(batch) + len(self._queue) - self.max_size
+            if overflow > 0:
+                self.dropped += overflow
+                if self.policy == 'drop_oldest':
+                    batch = batch[overflow:]
+                else:
+                    for _ in range(overflow):
+                        self._queue.pop()
+            self._queue.extendleft(reversed(batch))
+
+    def close(self):
+        self.flusher.stop()
+
+
+message_log = MessageLog()
@@ -0,0 +1,34 @@
+import threading
+
+
+class Metrics:
+    """Process-wide counters, cheap enough for the WebSocket hot path"""
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """Record a sample (e.g. seconds) as name.count, name.total and name.max"""
+        with self._lock:
+            self._counters[f'{name}.count'] = self._counters.get(f'{name}.count', 0) + 1
+            self._counters[f'{name}.total'] = self._counters.get(f'{name}.total', 0) + value
+            self._counters[f'{name}.max'] = max(self._counters.get(f'{name}.max', 0), value)
+
+    def get(self, name):
+        return self._counters.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.1 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('syncplay', '0002_alter_message_timestamp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='playback_rate',
+            field=models.FloatField(default=1.0),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='position_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-18 19:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('syncplay', '0003_room_playback_rate_room_position_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.1 on 2026-10-18 19:16
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_last_active_at(apps, schema_editor):
+    Room = apps.get_model('syncplay', 'Room')
+    User = apps.get_model('syncplay', 'User')
+    last_seen = User.objects.filter(room=OuterRef('pk')).values('room').annotate(
+        last_seen=Max('last_seen')
+    ).values('last_seen')
+    Room.objects.update(last_active_at=Coalesce(Subquery(last_seen), F('created_at')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('syncplay', '0004_room_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_active_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_last_active_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['-created_at', '-id'], name='syncplay_room_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.1 on 2026-10-18 19:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('syncplay', '0005_room_last_active_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', '-timestamp', '-id'], name='syncplay_msg_room_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='roomsession',
+            index=models.Index(fields=['last_activity'], name='syncplay_session_activity_idx'),
+        ),
+    ]
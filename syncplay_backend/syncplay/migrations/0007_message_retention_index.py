@@ -0,0 +1,17 @@
+# Generated by Django 5.0.1 on 2026-10-18 19:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('syncplay', '0006_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['message_type', 'timestamp'], name='syncplay_msg_type_ts_idx'),
+        ),
+    ]
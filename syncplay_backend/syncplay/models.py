@@ -1,7 +1,25 @@
 from django.db import models
+from django.db.models import Count, F
 from django.utils import timezone
 import uuid
 
+
+def extrapolate_position(position, is_playing, playback_rate, elapsed):
+    """Position in seconds after `elapsed` seconds of (possibly paused) playback"""
+    if not is_playing or elapsed <= 0:
+        return position
+    return position + elapsed * playback_rate
+
+class RoomQuerySet(models.QuerySet):
+    def with_user_count(self):
+        """Annotate the number of users, read by Room.user_count"""
+        return self.annotate(num_users=Count('users'))
+
+    def with_users(self):
+        """Prefetch users and annotate their count so serializing a room costs no extra queries"""
+        return self.with_user_count().prefetch_related('users')
+
+
 class Room(models.Model):
     """Model representing a SyncPlay room"""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -10,31 +28,87 @@ class Room(models.Model):
     current_video_url = models.URLField(blank=True, null=True)
     current_video_title = models.CharField(max_length=255, blank=True, null=True)
     current_position = models.DurationField(default=timezone.timedelta)
+    # Wall-clock time at which current_position was true
+    position_updated_at = models.DateTimeField(blank=True, null=True)
+    playback_rate = models.FloatField(default=1.0)
     is_playing = models.BooleanField(default=False)
+    # Bumped by every playback write; see versioned_update()
+    version = models.PositiveBigIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Last playback change or heartbeat, kept here so the lobby needs no join
+    last_active_at = models.DateTimeField(default=timezone.now, db_index=True)
+    
+    objects = RoomQuerySet.as_manager()
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='syncplay_room_created_id_idx'),
+        ]
     
     def __str__(self):
         return f"Room: {self.name} ({self.id})"
     
     @property
     def user_count(self):
+        num_users = getattr(self, 'num_users', None)
+        if num_users is not None:
+            return num_users
         return self.users.count()
     
-    def to_dict(self):
+    def versioned_update(self, expected_version=None, attempts=3, **fields):
+        """Write only `fields`, conditional on the row version.
+        
+        With `expected_version` the write is rejected (False) if the row has
+        moved past it. Without it the write is rebased: on conflict the version
+        is reloaded and the same fields are written on top, up to `attempts`
+        times. On success the instance and its version are updated.
+        """
+        fields.setdefault('updated_at', timezone.now())
+        fields.setdefault('last_active_at', fields['updated_at'])
+        version = self.version if expected_version is None else expected_version
+        for _ in range(attempts):
+            updated = Room.objects.filter(id=self.id, version=version).update(
+                version=F('version') + 1, **fields
+            )
+            if updated:
+                for field, value in fields.items():
+                    setattr(self, field, value)
+                self.version = version + 1
+                return True
+            self.refresh_from_db(fields=['version'])
+            if expected_version is not None:
+                return False
+            version = self.version
+        return False
+    
+    def position_at(self, now=None):
+        """Playback position in seconds at `now`, extrapolated from the last update"""
+        position = self.current_position.total_seconds() if self.current_position else 0.0
+        if not self.position_updated_at:
+            return position
+        elapsed = ((now or timezone.now()) - self.position_updated_at).total_seconds()
+        return extrapolate_position(position, self.is_playing, self.playback_rate, elapsed)
+    
+    def to_dict(self, users=None):
+        """Snapshot sent to clients; pass `users` when they are already loaded"""
+        now = timezone.now()
+        position = self.position_at(now)
         return {
             'id': str(self.id),
             'name': self.name,
             'host_id': str(self.host_id),
             'current_video_url': self.current_video_url,
             'current_video_title': self.current_video_title,
-            'current_position': int(self.current_position.total_seconds()) if self.current_position else 0,
+            'current_position': int(position),
+            'position': round(position, 3),
+            'playback_rate': self.playback_rate,
+            'position_updated_at': self.position_updated_at.isoformat() if self.position_updated_at else None,
+            'server_time': now.timestamp(),
             'is_playing': self.is_playing,
             'created_at': self.created_at.isoformat(),
-            'users': [user.to_dict() for user in self.users.all()],
+            'users': [user.to_dict() for user in (self.users.all() if users is None else users)],
         }
 
 class User(models.Model):
@@ -84,10 +158,17 @@ class Message(models.Model):
     user_id = models.UUIDField()
     message_type = models.CharField(max_length=20, choices=MESSAGE_TYPES)
     data = models.JSONField(default=dict)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the event happens, not when the batched insert runs
+    timestamp = models.DateTimeField(default=timezone.now)
     
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            # Room history, newest first, with the id as a tie-breaker for cursors
+            models.Index(fields=['room', '-timestamp', '-id'], name='syncplay_msg_room_ts_idx'),
+            # Retention sweeps, oldest first per type
+            models.Index(fields=['message_type', 'timestamp'], name='syncplay_msg_type_ts_idx'),
+        ]
     
     def __str__(self):
         return f"{self.message_type} message in {self.room.name} at {self.timestamp}"
@@ -112,6 +193,9 @@ class RoomSession(models.Model):
     
     class Meta:
         ordering = ['-connected_at']
+        indexes = [
+            models.Index(fields=['last_activity'], name='syncplay_session_activity_idx'),
+        ]
     
     def __str__(self):
         return f"Session for user {self.user_id} in room {self.room.name}"
@@ -0,0 +1,28 @@
+import uuid
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from rest_framework.pagination import CursorPagination
+
+
+class RoomCursorPagination(CursorPagination):
+    """Keyset pagination for the lobby: pages cost the same however deep they are"""
+    ordering = ('-created_at', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 500
+
+
+def encode_cursor(timestamp, pk):
+    """Opaque position of a message in a room's history, ordered by (timestamp, id)"""
+    return urlsafe_b64encode(f'{timestamp.isoformat()}|{pk}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(); raises ValueError for anything it did not produce"""
+    raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    timestamp, pk = raw.split('|')
+    return datetime.fromisoformat(timestamp), uuid.UUID(pk)
@@ -0,0 +1,21 @@
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+from . import codec
+
+
+class FastJSONParser(JSONParser):
+    """JSONParser backed by the configured codec (orjson/msgspec when installed)"""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+
+        try:
+            body = stream.read()
+            if encoding.lower().replace('-', '') != 'utf8':
+                body = body.decode(encoding)
+            return codec.loads(body)
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
@@ -0,0 +1,129 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+from .background import BackgroundFlusher
+from .models import Room, RoomSession
+
+logger = logging.getLogger('syncplay')
+
+ROOMS_KEY = 'syncplay:presence:rooms'
+
+
+def room_key(room_id):
+    return f'syncplay:presence:room:{room_id}'
+
+
+class PresenceTracker:
+    """Liveness of WebSocket sessions.
+
+    Heartbeats only update a timestamp in memory. A periodic sweep writes the
+    sessions seen since the previous sweep to RoomSession.last_activity with
+    one bulk UPDATE and, when SYNCPLAY_REDIS_URL is set, to per-room sorted
+    sets scored by last activity so other processes see the same liveness.
+    """
+
+    def __init__(self, sweep_interval=None, redis_url=None):
+        if sweep_interval is None:
+            sweep_interval = getattr(settings, 'SYNCPLAY_PRESENCE_SWEEP_INTERVAL', 30.0)
+        self.redis_url = redis_url or getattr(settings, 'SYNCPLAY_REDIS_URL', None)
+        self._redis = None
+        self._seen = {}
+        self._dirty = set()
+        self._gone = {}
+        self._lock = threading.Lock()
+        self.flusher = BackgroundFlusher('presence', sweep_interval, self.sweep)
+
+    @property
+    def redis(self):
+        if self._redis is None and self.redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(self.redis_url)
+        return self._redis
+
+    def touch(self, channel_name, room_id):
+        with self._lock:
+            self._seen[channel_name] = (str(room_id), timezone.now())
+            self._dirty.add(channel_name)
+        self.flusher.start()
+
+    def forget(self, channel_name):
+        with self._lock:
+            entry = self._seen.pop(channel_name, None)
+            self._dirty.discard(channel_name)
+            if entry and self.redis_url:
+                self._gone[channel_name] = entry[0]
+
+    def last_activity(self, channel_name):
+        entry = self._seen.get(channel_name)
+        return entry[1] if entry else None
+
+    def sweep(self):
+        with self._lock:
+            pending = {channel: self._seen[channel] for channel in self._dirty if channel in self._seen}
+            self._dirty.clear()
+            gone, self._gone = self._gone, {}
+        if gone:
+            pipe = self.redis.pipeline(transaction=False)
+            for channel, room_id in gone.items():
+                pipe.zrem(room_key(room_id), channel)
+            pipe.execute()
+        if not pending:
+            return
+
+        sessions = list(RoomSession.objects.filter(channel_name__in=pending).only('id', 'channel_name'))
+        for session in sessions:
+            session.last_activity = pending[session.channel_name][1]
+        RoomSession.objects.bulk_update(sessions, ['last_activity'], batch_size=1000)
+        # One UPDATE for every room in the sweep; accurate to a sweep interval
+        Room.objects.filter(id__in={room_id for room_id, _ in pending.values()}).update(
+            last_active_at=max(seen_at for _, seen_at in pending.values())
+        )
+
+        if self.redis is not None:
+            pipe = self.redis.pipeline(transaction=False)
+            rooms = {}
+            for channel, (room_id, seen_at) in pending.items():
+                score = seen_at.timestamp()
+                pipe.zadd(room_key(room_id), {channel: score})
+                rooms[room_id] = max(score, rooms.get(room_id, 0))
+            pipe.zadd(ROOMS_KEY, rooms, gt=True)
+            pipe.execute()
+        logger.debug(f"Presence sweep persisted {len(sessions)} sessions")
+
+    def active_channels(self, since):
+        """Channels seen since `since`, in this process or (with Redis) any process"""
+        channels = {channel for channel, (_, seen_at) in list(self._seen.items()) if seen_at >= since}
+        if self.redis is not None:
+            for room_id in self.active_room_ids(since):
+                channels.update(
+                    channel.decode() for channel in
+                    self.redis.zrangebyscore(room_key(room_id), since.timestamp(), '+inf')
+                )
+        return channels
+
+    def active_room_ids(self, since):
+        """Rooms with a session seen since `since`"""
+        room_ids = {room_id for room_id, seen_at in list(self._seen.values()) if seen_at >= since}
+        if self.redis is not None:
+            room_ids.update(
+                room_id.decode() for room_id in
+                self.redis.zrangebyscore(ROOMS_KEY, since.timestamp(), '+inf')
+            )
+        return room_ids
+
+    def prune(self, before):
+        """Drop Redis entries older than `before`"""
+        if self.redis is None:
+            return
+        stale_rooms = self.redis.zrangebyscore(ROOMS_KEY, '-inf', before.timestamp())
+        pipe = self.redis.pipeline(transaction=False)
+        for room_id in stale_rooms:
+            pipe.delete(room_key(room_id.decode()))
+        pipe.zremrangebyscore(ROOMS_KEY, '-inf', before.timestamp())
+        pipe.execute()
+
+
+presence = PresenceTracker()
@@ -0,0 +1,154 @@
+"""WebSocket wire protocols for the room socket.
+
+Clients that do not ask for a subprotocol get the original JSON text frames.
+Clients offering ``syncplay.msgpack`` get binary MessagePack frames shaped as
+``[opcode, data]`` or ``[opcode, data, extra]``, where ``extra`` holds any
+other top-level keys of the JSON message (``userId``, ...).
+
+The ``.deflate`` variants of both protocols additionally send frames larger
+than SYNCPLAY_COMPRESSION_THRESHOLD bytes as binary zlib streams. Those always
+start with 0x78, which neither a JSON object nor a compact frame can.
+"""
+import functools
+import zlib
+
+from django.conf import settings
+
+from . import codec
+
+try:
+    import msgpack
+except ImportError:  # msgpack ships with channels-redis but is optional here
+    msgpack = None
+
+JSON_PROTOCOL = 'syncplay.json'
+COMPACT_PROTOCOL = 'syncplay.msgpack'
+JSON_DEFLATE_PROTOCOL = 'syncplay.json.deflate'
+COMPACT_DEFLATE_PROTOCOL = 'syncplay.msgpack.deflate'
+
+ZLIB_HEADER = 0x78
+MAX_DECOMPRESSED_SIZE = 1024 * 1024
+
+OPCODES = {
+    'join': 1,
+    'leave': 2,
+    'play': 3,
+    'pause': 4,
+    'seek': 5,
+    'video_changed': 6,
+    'heartbeat': 7,
+    'room_update': 8,
+    'user_joined': 9,
+    'user_left': 10,
+    'error': 11,
+    'sync': 12,
+    'users_joined': 13,
+    'join_queued': 14,
+}
+MESSAGE_TYPES = {opcode: message_type for message_type, opcode in OPCODES.items()}
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def supported_protocols():
+    protocols = [JSON_PROTOCOL, JSON_DEFLATE_PROTOCOL]
+    if msgpack is not None:
+        protocols += [COMPACT_PROTOCOL, COMPACT_DEFLATE_PROTOCOL]
+    return protocols
+
+
+def is_compact(protocol):
+    return protocol in (COMPACT_PROTOCOL, COMPACT_DEFLATE_PROTOCOL)
+
+
+def is_deflate(protocol):
+    return protocol in (JSON_DEFLATE_PROTOCOL, COMPACT_DEFLATE_PROTOCOL)
+
+
+def negotiate(offered):
+    """Pick the first protocol we support from the client's offer, in its order"""
+    supported = supported_protocols()
+    for protocol in offered or ():
+        if protocol in supported:
+            return protocol
+    return None
+
+
+def encode_compact(message):
+    message = dict(message)
+    message_type = message.pop('type')
+    frame = [OPCODES.get(message_type, message_type), message.pop('data', None)]
+    if message:
+        frame.append(message)
+    return msgpack.packb(frame, use_bin_type=True)
+
+
+def decode_compact(payload):
+    try:
+        frame = msgpack.unpackb(payload, raw=False)
+    except Exception as e:
+        raise ProtocolError(f"Invalid MessagePack frame: {e}") from e
+    if not isinstance(frame, list) or len(frame) not in (2, 3):
+        raise ProtocolError("Compact frames must be [opcode, data] or [opcode, data, extra]")
+
+    opcode, data = frame[0], frame[1]
+    message = dict(frame[2]) if len(frame) == 3 and isinstance(frame[2], dict) else {}
+    message['type'] = MESSAGE_TYPES.get(opcode, opcode)
+    message['data'] = data if data is not None else {}
+    return message
+
+
+def compress(payload):
+    """Deflate a frame if it is worth it, otherwise return None"""
+    threshold = getattr(settings, 'SYNCPLAY_COMPRESSION_THRESHOLD', 1024)
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if not threshold or len(payload) < threshold:
+        return None
+    compressed = zlib.compress(payload, getattr(settings, 'SYNCPLAY_COMPRESSION_LEVEL', 6))
+    return compressed if len(compressed) < len(payload) else None
+
+
+def decompress(payload):
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload, MAX_DECOMPRESSED_SIZE)
+    except zlib.error as e:
+        raise ProtocolError(f"Invalid deflate frame: {e}") from e
+    if decompressor.unconsumed_tail:
+        raise ProtocolError("Deflate frame too large")
+    return data
+
+
+@functools.lru_cache(maxsize=256)
+def encode_frame(text, protocol):
+    """The frame `protocol` sends for a message already encoded as JSON `text`.
+
+    Broadcasts carry only the JSON text. Other variants are built the first
+    time a connection on this worker needs one and cached, so each is encoded
+    at most once per worker and never when nobody negotiated it. A deflate
+    variant is None when the frame is too small to compress; the plain frame
+    is used.
+    """
+    if protocol == JSON_DEFLATE_PROTOCOL:
+        return compress(text)
+    if protocol == COMPACT_PROTOCOL:
+        return encode_compact(codec.loads(text))
+    if protocol == COMPACT_DEFLATE_PROTOCOL:
+        return compress(encode_frame(text, COMPACT_PROTOCOL))
+    return text
+
+
+def decode(protocol, text_data=None, bytes_data=None):
+    """Decode a received frame into a message dict"""
+    if bytes_data is None:
+        return codec.loads(text_data)
+    if is_deflate(protocol) and bytes_data[:1] == bytes([ZLIB_HEADER]):
+        bytes_data = decompress(bytes_data)
+        if not is_compact(protocol):
+            return codec.loads(bytes_data)
+    if not is_compact(protocol):
+        raise ProtocolError("Binary frames require the compact protocol")
+    return decode_compact(bytes_data)
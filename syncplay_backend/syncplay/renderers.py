@@ -0,0 +1,20 @@
+from rest_framework.renderers import JSONRenderer
+
+from . import codec
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer backed by the configured codec (orjson/msgspec when installed)"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        renderer_context = renderer_context or {}
+        if self.get_indent(accepted_media_type, renderer_context):
+            # Pretty printing is for humans; keep DRF's formatting
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = codec.dumps_bytes(data, default=self.encoder_class().default)
+        # Same escaping as JSONRenderer so the output is also valid JavaScript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
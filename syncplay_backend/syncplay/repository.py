@@ -0,0 +1,106 @@
+"""Data access for the WebSocket consumer.
+
+Two implementations of the same coroutine interface, picked with
+SYNCPLAY_DB_ACCESS:
+
+- 'pool' (default) runs sync ORM code on the database thread pool
+  (see syncplay.db), one thread hop per operation.
+- 'async_orm' uses Django's async ORM methods (afirst, acreate, adelete...).
+  As of Django 5.0 those still run each query through sync_to_async on the
+  shared thread-sensitive executor, so this is not faster yet; it is here so
+  switching is a setting once Django ships natively async database backends.
+
+The join needs a transaction, which the async ORM cannot run, so it always
+goes through the pool.
+"""
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+
+from . import room_cache
+from .db import database_sync_to_async
+from .models import Room, User, RoomSession
+
+
+@database_sync_to_async
+def join_room(room_id, channel_name, user_id, user_name):
+    """Load the room, reuse or create the user and open the session in one transaction.
+
+    Returns (room, user, room data) or (None, None, error message).
+    """
+    try:
+        # Clients may send any spelling of the UUID (case, dashes, braces)
+        user_id = uuid.UUID(str(user_id))
+    except ValueError:
+        return None, None, "Invalid user ID"
+
+    with transaction.atomic():
+        # Joins to the same room queue here, so exactly one becomes host
+        room = Room.objects.select_for_update().filter(id=room_id).first()
+        if not room:
+            return None, None, "Room not found"
+
+        users = list(room.users.all())
+        user = next((u for u in users if u.id == user_id), None)
+        if not user:
+            if any(u.name == user_name for u in users):
+                return None, None, "User name already taken"
+            user = User.objects.create(
+                id=user_id,
+                room=room,
+                name=user_name,
+                is_host=not users  # First user becomes host
+            )
+            users.append(user)
+            transaction.on_commit(lambda: room_cache.invalidate(room.id))
+
+        RoomSession.objects.create(
+            room=room,
+            user_id=user.id,
+            channel_name=channel_name
+        )
+    return room, user, room.to_dict(users=users)
+
+
+class PooledRoomRepository:
+    async def join(self, room_id, channel_name, user_id, user_name):
+        return await join_room(room_id, channel_name, user_id, user_name)
+
+    @database_sync_to_async
+    def remove_user(self, user):
+        user.delete()
+        room_cache.invalidate(user.room_id)
+
+    @database_sync_to_async
+    def remove_session(self, channel_name):
+        RoomSession.objects.filter(channel_name=channel_name).delete()
+
+    @database_sync_to_async
+    def room_to_dict(self, room):
+        return room.to_dict()
+
+
+class AsyncOrmRoomRepository(PooledRoomRepository):
+    async def remove_user(self, user):
+        room_id = user.room_id
+        await user.adelete()
+        await room_cache.ainvalidate(room_id)
+
+    async def remove_session(self, channel_name):
+        await RoomSession.objects.filter(channel_name=channel_name).adelete()
+
+    async def room_to_dict(self, room):
+        return room.to_dict(users=[user async for user in room.users.all()])
+
+
+def get_repository():
+    access = getattr(settings, 'SYNCPLAY_DB_ACCESS', 'pool')
+    if access == 'pool':
+        return PooledRoomRepository()
+    if access == 'async_orm':
+        return AsyncOrmRoomRepository()
+    raise ValueError(f"Unknown database access mode: {access}")
+
+
+room_repository = get_repository()
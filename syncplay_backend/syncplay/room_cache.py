@@ -0,0 +1,107 @@
+"""Cached read model for the room REST endpoints.
+
+Serialized rooms and lobby pages live in the Django cache next to an ETag, so
+polling clients are answered without touching the database and get a 304 when
+nothing changed. Every path that writes a Room row or its users calls
+invalidate(); lobby pages are keyed by a generation counter that invalidate()
+bumps, so all of them go stale at once. Lobby pages also expire quickly since
+rooms drop out of the activity window without being written.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import codec
+from .models import extrapolate_position
+
+LOBBY_GENERATION_KEY = 'syncplay:lobby:generation'
+
+
+def room_key(room_id):
+    return f'syncplay:room:{room_id}:summary'
+
+
+def lobby_key(generation, url):
+    digest = hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+    return f'syncplay:lobby:{generation}:{digest}'
+
+
+def make_entry(data, weak=False, **extra):
+    body = codec.dumps_bytes(data)
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    return {'data': data, 'etag': f'W/{etag}' if weak else etag, **extra}
+
+
+def get_room(room_id):
+    return cache.get(room_key(room_id))
+
+
+def set_room(room, data):
+    # The position keeps moving while playing; keep what is needed to
+    # extrapolate it at read time instead of caching a stale value. The
+    # body then differs between reads of the same entry, so its tag is weak
+    entry = make_entry(dict(data), weak=True, anchor=(
+        room.current_position.total_seconds(),
+        room.position_updated_at.timestamp() if room.position_updated_at else None,
+        room.is_playing,
+        room.playback_rate,
+    ))
+    cache.set(room_key(room.id), entry, getattr(settings, 'SYNCPLAY_ROOM_CACHE_TTL', 60))
+    return entry
+
+
+def room_data(entry):
+    """The cached room with its position extrapolated to now"""
+    position, updated_at, is_playing, playback_rate = entry['anchor']
+    elapsed = timezone.now().timestamp() - updated_at if updated_at else 0
+    data = dict(entry['data'])
+    data['position'] = round(extrapolate_position(position, is_playing, playback_rate, elapsed), 3)
+    return data
+
+
+def get_lobby(url):
+    return cache.get(lobby_key(cache.get(LOBBY_GENERATION_KEY, 0), url))
+
+
+def set_lobby(url, data):
+    entry = make_entry(data)
+    cache.set(
+        lobby_key(cache.get(LOBBY_GENERATION_KEY, 0), url),
+        entry,
+        getattr(settings, 'SYNCPLAY_LOBBY_CACHE_TTL', 5),
+    )
+    return entry
+
+
+def opaque_tag(etag):
+    return etag.strip().removeprefix('W/')
+
+
+def not_modified(request, entry):
+    # If-None-Match uses the weak comparison: W/ prefixes don't matter
+    etags = [opaque_tag(etag) for etag in request.headers.get('If-None-Match', '').split(',')]
+    return opaque_tag(entry['etag']) in etags or '*' in etags
+
+
+async def ainvalidate(*room_ids):
+    """invalidate() for the event loop"""
+    if room_ids:
+        await cache.adelete_many([room_key(room_id) for room_id in room_ids])
+    await cache.aadd(LOBBY_GENERATION_KEY, 0, None)
+    try:
+        await cache.aincr(LOBBY_GENERATION_KEY)
+    except ValueError:
+        await cache.aset(LOBBY_GENERATION_KEY, 1, None)
+
+
+def invalidate(*room_ids):
+    if room_ids:
+        cache.delete_many([room_key(room_id) for room_id in room_ids])
+    cache.add(LOBBY_GENERATION_KEY, 0, None)
+    try:
+        cache.incr(LOBBY_GENERATION_KEY)
+    except ValueError:
+        # Evicted between add() and incr(); a fresh generation is just as good
+        cache.set(LOBBY_GENERATION_KEY, 1, None)
@@ -0,0 +1,469 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import codec, room_cache
+from .background import BackgroundFlusher
+from .models import Room, extrapolate_position
+
+logger = logging.getLogger('syncplay')
+
+
+class RoomState:
+    """Playback state of a room, written behind to the database.
+
+    `version` counts changes seen by clients; `db_version` is the Room.version
+    the state was last loaded from or written at, used for conditional writes.
+    """
+
+    def __init__(self, room_id, is_playing=False, position=0.0, playback_rate=1.0,
+                 video_url=None, video_title=None, version=0, db_version=0):
+        self.room_id = room_id
+        self.is_playing = is_playing
+        self.playback_rate = playback_rate
+        self.video_url = video_url
+        self.video_title = video_title
+        self.version = version
+        self.db_version = db_version
+        self._set_reference(float(position))
+
+    @classmethod
+    def from_room(cls, room):
+        state = cls(room_id=str(room.id))
+        state.load(room)
+        return state
+
+    def load(self, room):
+        self.is_playing = room.is_playing
+        self.playback_rate = room.playback_rate
+        self.video_url = room.current_video_url
+        self.video_title = room.current_video_title
+        self.db_version = room.version
+        self._set_reference(room.position_at())
+
+    def _set_reference(self, position):
+        # `position` was true at both clocks: wall time for clients and the
+        # database, monotonic time for extrapolating inside this process
+        self.position = position
+        self.updated_at = timezone.now()
+        self.reference_monotonic = time.monotonic()
+
+    def position_now(self):
+        elapsed = time.monotonic() - self.reference_monotonic
+        return extrapolate_position(self.position, self.is_playing, self.playback_rate, elapsed)
+
+    def apply(self, **changes):
+        position = changes.pop('position', None)
+        if position is None:
+            position = self.position_now()
+        for field, value in changes.items():
+            setattr(self, field, value)
+        self._set_reference(float(position))
+        self.version += 1
+
+    def bump(self):
+        """Record a change that is not playback state (membership) and return the new version"""
+        self.version += 1
+        return self.version
+
+    def to_dict(self):
+        # Same keys as Room.to_dict() so it can be overlaid on a database snapshot
+        position = self.position_now()
+        return {
+            'current_video_url': self.video_url,
+            'current_video_title': self.video_title,
+            'current_position': int(position),
+            'position': round(position, 3),
+            'playback_rate': self.playback_rate,
+            'position_updated_at': self.updated_at.isoformat(),
+            'server_time': timezone.now().timestamp(),
+            'is_playing': self.is_playing,
+            'version': self.version,
+        }
+
+    def to_mapping(self):
+        """Plain representation stored in Redis; `updated_at` is the reference instant"""
+        return {
+            'is_playing': self.is_playing,
+            'position': self.position,
+            'updated_at': self.updated_at.timestamp(),
+            'playback_rate': self.playback_rate,
+            'video_url': self.video_url,
+            'video_title': self.video_title,
+        }
+
+    @classmethod
+    def from_mapping(cls, room_id, mapping, version):
+        state = cls(
+            room_id=room_id,
+            is_playing=mapping['is_playing'],
+            playback_rate=mapping['playback_rate'],
+            video_url=mapping['video_url'],
+            video_title=mapping['video_title'],
+            version=version,
+        )
+        # Another process set the reference; rebuild our monotonic side of it
+        state.position = mapping['position']
+        state.updated_at = datetime.fromtimestamp(mapping['updated_at'], tz=dt_timezone.utc)
+        state.reference_monotonic = time.monotonic() - (time.time() - mapping['updated_at'])
+        return state
+
+    def to_fields(self):
+        return {
+            'is_playing': self.is_playing,
+            'current_position': timedelta(seconds=self.position),
+            'position_updated_at': self.updated_at,
+            'playback_rate': self.playback_rate,
+            'current_video_url': self.video_url,
+            'current_video_title': self.video_title,
+            'updated_at': timezone.now(),
+            'last_active_at': timezone.now(),
+        }
+
+    def to_pending(self):
+        """What a flush writes: the fields and the version they are based on"""
+        return self.to_fields(), self.db_version
+
+
+class RoomStateStore:
+    """In-process registry of room states with a coalescing write-behind flusher.
+
+    Consumers mutate the state and broadcast straight away; rooms touched since
+    the last flush are written in one transaction every flush interval, so a
+    burst of seeks costs a single UPDATE per room. Only correct when a single
+    process serves each room; see RedisRoomStateStore otherwise.
+
+    The consumer-facing methods are coroutines so both stores are interchangeable.
+    """
+
+    def __init__(self, flush_interval=None):
+        if flush_interval is None:
+            flush_interval = getattr(settings, 'SYNCPLAY_STATE_FLUSH_INTERVAL', 1.0)
+        self._states = {}
+        self._members = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self.flusher = BackgroundFlusher('room-state', flush_interval, self.flush)
+
+    async def get(self, room_id):
+        return self._states.get(str(room_id))
+
+    async def acquire(self, room, channel_name):
+        """Load the state of a room and pin it in memory for a connection"""
+        room_id = str(room.id)
+        with self._lock:
+            state = self._states.get(room_id)
+            if state is None:
+                state = self._states[room_id] = RoomState.from_room(room)
+            self._members.setdefault(room_id, set()).add(channel_name)
+        self.flusher.start()
+        return state
+
+    async def release(self, room_id, channel_name):
+        """Unpin a room; it is dropped from memory once its changes are flushed"""
+        room_id = str(room_id)
+        with self._lock:
+            members = self._members.get(room_id, set())
+            members.discard(channel_name)
+            if members:
+                return
+            self._members.pop(room_id, None)
+            if room_id not in self._dirty:
+                self._states.pop(room_id, None)
+
+    async def update(self, room_id, **changes):
+        room_id = str(room_id)
+        with self._lock:
+            state = self._states.get(room_id)
+            if state is None:
+                return None
+            state.apply(**changes)
+            self._dirty.add(room_id)
+        return state
+
+    async def bump(self, room_id):
+        with self._lock:
+            state = self._states.get(str(room_id))
+            return state.bump() if state else None
+
+    def refresh(self, room):
+        """Reload a loaded state from a room that was just saved elsewhere"""
+        room_id = str(room.id)
+        with self._lock:
+            state = self._states.get(room_id)
+            if state is None:
+                return
+            state.load(room)
+            state.bump()
+            self._dirty.discard(room_id)
+
+    def flush(self):
+        with self._lock:
+            pending = {
+                room_id: self._states[room_id].to_pending()
+                for room_id in self._dirty if room_id in self._states
+            }
+            self._dirty.clear()
+        if not pending:
+            return
+
+        try:
+            written, superseded = write_room_fields(pending)
+        except Exception:
+            with self._lock:
+                self._dirty.update(pending)
+            raise
+
+        with self._lock:
+            for room_id, db_version in written.items():
+                if room_id in self._states:
+                    self._states[room_id].db_version = db_version
+            for room_id, room in superseded.items():
+                # A newer write reached the database first; adopt it unless
+                # the room changed again in the meantime
+                if room_id in self._states and room_id not in self._dirty:
+                    self._states[room_id].load(room)
+                    self._states[room_id].bump()
+            for room_id in pending:
+                if room_id not in self._members and room_id not in self._dirty:
+                    self._states.pop(room_id, None)
+        logger.debug(f"Flushed playback state for {len(pending)} rooms")
+
+
+class RedisRoomStateStore:
+    """Room state shared by every worker through Redis.
+
+    Each room is a hash holding the playback state (`data`, JSON), a
+    `version` counter and the `db_version` it was last persisted at; updates are compare-and-set through WATCH/MULTI so
+    concurrent workers never lose each other's writes. A set per room tracks
+    the channels connected to it on any worker, and a global set lists rooms
+    waiting to be written to the database. Any worker's flusher may claim a
+    dirty room with SPOP, so each change is written once.
+    """
+
+    DIRTY_KEY = 'syncplay:rooms:dirty'
+
+    def __init__(self, redis_url=None, flush_interval=None, ttl=None):
+        if flush_interval is None:
+            flush_interval = getattr(settings, 'SYNCPLAY_STATE_FLUSH_INTERVAL', 1.0)
+        self.redis_url = redis_url or getattr(settings, 'SYNCPLAY_REDIS_URL', None)
+        self.ttl = ttl or getattr(settings, 'SYNCPLAY_ROOM_STATE_TTL', 3600)
+        self._redis = None
+        self._async_redis = {}
+        self.flusher = BackgroundFlusher('room-state', flush_interval, self.flush)
+
+    @staticmethod
+    def state_key(room_id):
+        return f'syncplay:room:{room_id}:state'
+
+    @staticmethod
+    def members_key(room_id):
+        return f'syncplay:room:{room_id}:members'
+
+    @property
+    def redis(self):
+        """Blocking client for the flusher thread and sync views"""
+        if self._redis is None:
+            import redis
+            self._redis = redis.Redis.from_url(self.redis_url)
+        return self._redis
+
+    @property
+    def async_redis(self):
+        # Async connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        client = self._async_redis.get(loop)
+        if client is None:
+            import redis.asyncio
+            client = self._async_redis[loop] = redis.asyncio.Redis.from_url(self.redis_url)
+        return client
+
+    def _decode(self, room_id, raw):
+        if not raw or b'data' not in raw:
+            return None
+        state = RoomState.from_mapping(room_id, codec.loads(raw[b'data']), int(raw.get(b'version', 0)))
+        state.db_version = int(raw.get(b'db_version', 0))
+        return state
+
+    async def get(self, room_id):
+        room_id = str(room_id)
+        return self._decode(room_id, await self.async_redis.hgetall(self.state_key(room_id)))
+
+    async def acquire(self, room, channel_name):
+        room_id = str(room.id)
+        key = self.state_key(room_id)
+        client = self.async_redis
+        initial = codec.dumps(RoomState.from_room(room).to_mapping())
+        async with client.pipeline(transaction=True) as pipe:
+            # The first worker to see the room seeds it from the database
+            pipe.hsetnx(key, 'data', initial)
+            pipe.hsetnx(key, 'version', 0)
+            pipe.hsetnx(key, 'db_version', room.version)
+            pipe.persist(key)
+            pipe.sadd(self.members_key(room_id), channel_name)
+            pipe.persist(self.members_key(room_id))
+            await pipe.execute()
+        self.flusher.start()
+        return await self.get(room_id)
+
+    async def release(self, room_id, channel_name):
+        import redis
+        room_id = str(room_id)
+        members = self.members_key(room_id)
+        async with self.async_redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    # A join on another worker between the count and the
+                    # expire would leave its member in a room about to expire
+                    await pipe.watch(members)
+                    others = int(await pipe.scard(members)) - int(await pipe.sismember(members, channel_name))
+                    pipe.multi()
+                    pipe.srem(members, channel_name)
+                    if not others:
+                        # Keep the state around for reconnects; the flusher writes it first
+                        pipe.expire(self.state_key(room_id), self.ttl)
+                    await pipe.execute()
+                    return
+                except redis.WatchError:
+                    await pipe.reset()
+
+    async def update(self, room_id, **changes):
+        import redis
+        room_id = str(room_id)
+        key = self.state_key(room_id)
+        async with self.async_redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    state = self._decode(room_id, await pipe.hgetall(key))
+                    if state is None:
+                        await pipe.unwatch()
+                        return None
+                    state.apply(**changes)
+                    pipe.multi()
+                    pipe.hset(key, mapping={'data': codec.dumps(state.to_mapping()), 'version': state.version})
+                    pipe.sadd(self.DIRTY_KEY, room_id)
+                    await pipe.execute()
+                    return state
+                except redis.WatchError:
+                    # Another worker changed the room first; rebase on its state
+                    await pipe.reset()
+
+    async def bump(self, room_id):
+        room_id = str(room_id)
+        key = self.state_key(room_id)
+        if not await self.async_redis.exists(key):
+            return None
+        return await self.async_redis.hincrby(key, 'version', 1)
+
+    def refresh(self, room):
+        room_id = str(room.id)
+        key = self.state_key(room_id)
+        if not self.redis.exists(key):
+            return
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(key, mapping={
+            'data': codec.dumps(RoomState.from_room(room).to_mapping()),
+            'db_version': room.version,
+        })
+        pipe.hincrby(key, 'version', 1)
+        pipe.srem(self.DIRTY_KEY, room_id)
+        pipe.execute()
+
+    def flush(self):
+        batch_size = getattr(settings, 'SYNCPLAY_STATE_FLUSH_BATCH_SIZE', 500)
+        while True:
+            room_ids = [room_id.decode() for room_id in self.redis.spop(self.DIRTY_KEY, batch_size) or []]
+            if not room_ids:
+                return
+            pipe = self.redis.pipeline(transaction=False)
+            for room_id in room_ids:
+                pipe.hgetall(self.state_key(room_id))
+            pending = {}
+            seen_versions = {}
+            for room_id, raw in zip(room_ids, pipe.execute()):
+                state = self._decode(room_id, raw)
+                if state is not None:
+                    pending[room_id] = state.to_pending()
+                    seen_versions[room_id] = state.version
+            try:
+                written, superseded = write_room_fields(pending)
+            except Exception:
+                if room_ids:
+                    self.redis.sadd(self.DIRTY_KEY, *room_ids)
+                raise
+
+            pipe = self.redis.pipeline(transaction=False)
+            for room_id, db_version in written.items():
+                pipe.hset(self.state_key(room_id), 'db_version', db_version)
+            pipe.execute()
+            for room_id, room in superseded.items():
+                self._rebase(room, seen_versions[room_id])
+            logger.debug(f"Flushed shared playback state for {len(pending)} rooms")
+
+    def _rebase(self, room, seen_version):
+        """Adopt a newer database row unless the room changed again since the flush read it"""
+        import redis
+        key = self.state_key(room.id)
+        with self.redis.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(key)
+                if int(pipe.hget(key, 'version') or -1) != seen_version:
+                    return
+                pipe.multi()
+                pipe.hset(key, mapping={
+                    'data': codec.dumps(RoomState.from_room(room).to_mapping()),
+                    'db_version': room.version,
+                })
+                pipe.hincrby(key, 'version', 1)
+                pipe.execute()
+            except redis.WatchError:
+                # Changed again; the next flush settles it
+                pass
+
+
+def write_room_fields(pending):
+    """Write {room_id: (fields, db_version)} in one transaction.
+
+    Each room gets one narrow UPDATE conditional on the version its state was
+    based on. If the row has moved on (a REST write or another process), the
+    more recent of the two changes wins: ours is written on top of the current
+    row, or the row is returned so the caller can reload from it.
+
+    Returns ({room_id: new db_version}, {room_id: newer Room}).
+    """
+    written, superseded = {}, {}
+    with transaction.atomic():
+        for room_id, (fields, db_version) in pending.items():
+            if Room.objects.filter(id=room_id, version=db_version).update(version=F('version') + 1, **fields):
+                written[room_id] = db_version + 1
+                continue
+            room = Room.objects.select_for_update().filter(id=room_id).first()
+            if room is None:
+                continue
+            if room.position_updated_at and room.position_updated_at > fields['position_updated_at']:
+                superseded[room_id] = room
+            else:
+                Room.objects.filter(id=room_id).update(version=F('version') + 1, **fields)
+                written[room_id] = room.version + 1
+    room_cache.invalidate(*written)
+    return written, superseded
+
+
+def get_room_state_store():
+    backend = getattr(settings, 'SYNCPLAY_ROOM_STATE_BACKEND', 'memory')
+    if backend == 'redis':
+        return RedisRoomStateStore()
+    if backend == 'memory':
+        return RoomStateStore()
+    raise ValueError(f"Unknown room state backend: {backend}")
+
+
+room_states = get_room_state_store()
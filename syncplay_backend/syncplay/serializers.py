@@ -11,15 +11,35 @@ class UserSerializer(serializers.ModelSerializer):
 class RoomSerializer(serializers.ModelSerializer):
     users = UserSerializer(many=True, read_only=True)
     user_count = serializers.ReadOnlyField()
+    position = serializers.SerializerMethodField()
+    # The database row version, for conditional writes; not the WebSocket
+    # `version`, which counts changes broadcast to connected clients
+    db_version = serializers.IntegerField(source='version', read_only=True)
     
     class Meta:
         model = Room
         fields = [
             'id', 'name', 'host_id', 'current_video_url', 
-            'current_video_title', 'current_position', 
-            'is_playing', 'created_at', 'users', 'user_count'
+            'current_video_title', 'current_position', 'position',
+            'playback_rate', 'position_updated_at',
+            'is_playing', 'db_version', 'created_at', 'users', 'user_count'
         ]
         read_only_fields = ['id', 'created_at']
+    
+    def get_position(self, obj):
+        return round(obj.position_at(), 3)
+
+class RoomSummarySerializer(serializers.ModelSerializer):
+    """Lobby entry: what a room list needs, without the user list"""
+    user_count = serializers.ReadOnlyField()
+    
+    class Meta:
+        model = Room
+        fields = [
+            'id', 'name', 'current_video_title', 'is_playing',
+            'user_count', 'created_at', 'last_active_at'
+        ]
+        read_only_fields = fields
 
 class CreateRoomSerializer(serializers.Serializer):
     room_name = serializers.CharField(max_length=100)
@@ -60,10 +80,12 @@ class MessageSerializer(serializers.ModelSerializer):
 class VideoControlSerializer(serializers.Serializer):
     action = serializers.ChoiceField(choices=['play', 'pause', 'seek'])
     position = serializers.IntegerField(min_value=0, help_text="Position in seconds")
+    db_version = serializers.IntegerField(min_value=0, required=False, help_text="Room db_version the change is based on")
     
 class VideoChangeSerializer(serializers.Serializer):
     video_url = serializers.URLField()
     video_title = serializers.CharField(max_length=255)
+    db_version = serializers.IntegerField(min_value=0, required=False, help_text="Room db_version the change is based on")
 
 class RoomStatusSerializer(serializers.Serializer):
     room = RoomSerializer()
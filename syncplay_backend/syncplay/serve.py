@@ -0,0 +1,357 @@
+"""Production launcher: N Daphne worker processes on uvloop.
+
+    python -m syncplay.serve --workers 4 --port 8000
+
+The supervisor forks the workers before Django is set up in them: daphne
+builds its Twisted reactor on an asyncio loop as soon as it is imported
+(django.setup() does that, daphne being an installed app), so each worker
+installs the uvloop policy first. Each worker binds its own listening socket
+with SO_REUSEPORT and the kernel spreads connections across them; where
+SO_REUSEPORT is unavailable the supervisor binds one socket they all share.
+
+SIGTERM or SIGINT drains: workers stop accepting, close WebSockets with
+DRAIN_CLOSE_CODE so clients reconnect elsewhere, wait up to the drain timeout
+for consumers to finish, then flush pending room state and messages. SIGHUP
+replaces the workers one at a time. Workers that crash are restarted.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from multiprocessing.connection import wait
+
+logger = logging.getLogger('syncplay')
+
+# Seconds a worker gets on top of the drain timeout before it is killed
+KILL_GRACE = 10
+
+# Close code for WebSockets dropped by a draining worker. autobahn does not let
+# servers send 1001 (going away), so it comes from the application range.
+DRAIN_CLOSE_CODE = 4001
+
+
+def bind_socket(host, port, backlog, keepalive, reuse_port):
+    # IPv4 only: daphne adopts the socket through Twisted's fd endpoint,
+    # which assumes AF_INET
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if keepalive:
+        # Accepted connections inherit these; dead peers holding a room
+        # seat are noticed even when the WebSocket pings are disabled
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, keepalive)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, keepalive // 4))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def install_event_loop():
+    try:
+        import uvloop
+    except ImportError:
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
+
+
+def run_worker(index, options, ready, shared_socket=None):
+    """Worker process body: set up Django on uvloop and serve until drained"""
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    loop_name = install_event_loop()
+
+    import django
+    django.setup()
+
+    from daphne.server import Server
+    from daphne.ws_protocol import WebSocketProtocol
+    from django.conf import settings
+    from django.db import connections
+    from django.utils.module_loading import import_string
+    from twisted.internet import reactor
+
+    from .background import shutdown_flushers
+    from .db import get_executor
+
+    class DrainingServer(Server):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.ports = []
+            self.draining = False
+
+        def listen_success(self, port):
+            self.ports.append(port)
+            super().listen_success(port)
+
+        def drain(self):
+            if self.draining:
+                return
+            self.draining = True
+            for port in self.ports:
+                port.stopListening()
+            closed = 0
+            for protocol in list(self.connections):
+                if not isinstance(protocol, WebSocketProtocol):
+                    continue
+                if protocol.state == protocol.STATE_OPEN:
+                    protocol.serverClose(code=DRAIN_CLOSE_CODE)
+                    closed += 1
+                elif protocol.state == protocol.STATE_CONNECTING:
+                    protocol.serverReject()
+            logger.info(f"Worker {index} draining, closed {closed} WebSockets")
+            self.wait_drained(time.monotonic() + options.drain_timeout)
+
+        def wait_drained(self, deadline):
+            # Connections leave the table once their consumer has finished
+            if self.connections and time.monotonic() < deadline:
+                reactor.callLater(0.1, self.wait_drained, deadline)
+                return
+            if self.connections:
+                logger.warning(f"Worker {index} drain timed out with {len(self.connections)} connections left")
+            self.stop()
+
+    sock = shared_socket or bind_socket(
+        options.bind, options.port, options.backlog, options.keepalive, reuse_port=True,
+    )
+    proxy_headers = options.proxy_headers
+    server = DrainingServer(
+        import_string(settings.ASGI_APPLICATION),
+        endpoints=[f'fd:fileno={sock.fileno()}'],
+        signal_handlers=False,
+        ping_interval=options.ping_interval,
+        ping_timeout=options.ping_timeout,
+        websocket_timeout=options.websocket_timeout,
+        application_close_timeout=options.drain_timeout,
+        proxy_forwarded_address_header='X-Forwarded-For' if proxy_headers else None,
+        proxy_forwarded_port_header='X-Forwarded-Port' if proxy_headers else None,
+        proxy_forwarded_proto_header='X-Forwarded-Proto' if proxy_headers else None,
+        verbosity=options.verbosity,
+        ready_callable=ready.set,
+    )
+
+    def on_signal(signum, frame):
+        reactor.callFromThread(server.drain)
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, on_signal)
+
+    supervisor_pid = os.getppid()
+
+    def watch_supervisor():
+        # A killed supervisor cannot stop us; drain instead of lingering on the port
+        if os.getppid() != supervisor_pid:
+            logger.warning(f"Worker {index} lost its supervisor")
+            server.drain()
+        elif not server.draining:
+            reactor.callLater(1, watch_supervisor)
+
+    reactor.callLater(1, watch_supervisor)
+
+    logger.info(f"Worker {index} (pid {os.getpid()}) serving on {options.bind}:{options.port} with {loop_name}")
+    try:
+        server.run()
+    finally:
+        # multiprocessing skips atexit in workers; flush what is still pending
+        get_executor().shutdown(wait=True)
+        shutdown_flushers()
+        connections.close_all()
+        logger.info(f"Worker {index} stopped")
+
+
+class Supervisor:
+    """Starts the workers, restarts the ones that die and coordinates shutdown"""
+
+    def __init__(self, options):
+        self.options = options
+        self.context = multiprocessing.get_context('fork')
+        self.workers = {}
+        self.stopping = False
+        self.reload = False
+        self.started_ok = True
+        self.shared_socket = None
+
+    def run(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            self.shared_socket = bind_socket(
+                self.options.bind, self.options.port, self.options.backlog,
+                self.options.keepalive, reuse_port=False,
+            )
+
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        logger.info(f"Starting {self.options.workers} workers on {self.options.bind}:{self.options.port}")
+        for index in range(self.options.workers):
+            self.spawn(index)
+
+        while not self.stopping:
+            if self.reload:
+                self.reload = False
+                self.restart_all()
+            processes = [process for process, _ in self.workers.values()]
+            for sentinel in wait([process.sentinel for process in processes], timeout=1):
+                self.reap(next(process for process in processes if process.sentinel == sentinel))
+
+        self.stop_all()
+        return 0 if self.started_ok else 1
+
+    def spawn(self, index):
+        ready = self.context.Event()
+        process = self.context.Process(
+            target=run_worker,
+            args=(index, self.options, ready, self.shared_socket),
+            name=f'syncplay-worker-{index}',
+        )
+        process.start()
+        self.workers[index] = (process, ready)
+        return process, ready
+
+    def reap(self, process):
+        index = next(i for i, (p, _) in self.workers.items() if p is process)
+        _, ready = self.workers.pop(index)
+        process.join()
+        if self.stopping:
+            return
+        if not ready.is_set():
+            # Failed during startup (port in use, bad settings): restarting won't help
+            logger.error(f"Worker {index} exited with code {process.exitcode} before serving; shutting down")
+            self.started_ok = False
+            self.stopping = True
+            return
+        logger.warning(f"Worker {index} exited with code {process.exitcode}; restarting")
+        self.spawn(index)
+
+    def restart_all(self):
+        """Replace workers one at a time; the others keep serving meanwhile"""
+        logger.info("Restarting workers")
+        for index in list(self.workers):
+            old, old_ready = self.workers.pop(index)
+            process, ready = self.spawn(index)
+            while not ready.wait(0.5):
+                if not process.is_alive() or self.stopping:
+                    break
+            if not ready.is_set():
+                logger.error(f"Replacement for worker {index} failed to start; keeping the old one")
+                self.stop_processes([process])
+                self.workers[index] = (old, old_ready)
+                return
+            self.stop_processes([old])
+
+    def stop_all(self):
+        logger.info("Stopping workers")
+        self.stop_processes([process for process, _ in self.workers.values()])
+        self.workers.clear()
+
+    def stop_processes(self, processes):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.options.drain_timeout + KILL_GRACE
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker pid {process.pid} did not drain in time; killing it")
+                process.kill()
+                process.join()
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_reload(self, signum, frame):
+        self.reload = True
+
+
+def parse_args(argv=None):
+    from django.conf import settings
+
+    parser = argparse.ArgumentParser(prog='python -m syncplay.serve', description=__doc__.split('\n')[0])
+    parser.add_argument('-b', '--bind', default='0.0.0.0', help='IPv4 address to listen on (default: 0.0.0.0)')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument(
+        '-w', '--workers', type=int,
+        default=getattr(settings, 'SYNCPLAY_WORKERS', 0) or None,
+        help='Worker processes (default: SYNCPLAY_WORKERS, or one per CPU with shared backends, else 1)',
+    )
+    parser.add_argument(
+        '--backlog', type=int, default=getattr(settings, 'SYNCPLAY_LISTEN_BACKLOG', 2048),
+        help='Pending connections queued per listening socket (default: SYNCPLAY_LISTEN_BACKLOG)',
+    )
+    parser.add_argument(
+        '--keepalive', type=int, default=getattr(settings, 'SYNCPLAY_TCP_KEEPALIVE', 60),
+        help='Idle seconds before TCP keepalive probes, 0 to disable (default: SYNCPLAY_TCP_KEEPALIVE)',
+    )
+    parser.add_argument(
+        '--ping-interval', type=float, default=getattr(settings, 'SYNCPLAY_WS_PING_INTERVAL', 20),
+        help='Seconds between WebSocket pings (default: SYNCPLAY_WS_PING_INTERVAL)',
+    )
+    parser.add_argument(
+        '--ping-timeout', type=float, default=getattr(settings, 'SYNCPLAY_WS_PING_TIMEOUT', 30),
+        help='Seconds without a pong before a WebSocket is closed (default: SYNCPLAY_WS_PING_TIMEOUT)',
+    )
+    parser.add_argument(
+        '--websocket-timeout', type=float, default=-1,
+        help='Maximum WebSocket lifetime in seconds, -1 for none (default: -1)',
+    )
+    parser.add_argument(
+        '--drain-timeout', type=float, default=getattr(settings, 'SYNCPLAY_DRAIN_TIMEOUT', 30),
+        help='Seconds workers wait for connections to finish on shutdown (default: SYNCPLAY_DRAIN_TIMEOUT)',
+    )
+    parser.add_argument(
+        '--proxy-headers', action='store_true',
+        help='Take the client address and scheme from X-Forwarded-* headers',
+    )
+    parser.add_argument('-v', '--verbosity', type=int, default=1, help='Daphne log verbosity (default: 1)')
+    options = parser.parse_args(argv)
+    single_process = single_process_backend(settings)
+    if options.workers is None:
+        # Only a worker count someone asked for is refused below
+        options.workers = 1 if single_process else os.cpu_count()
+    if options.workers < 1:
+        parser.error('--workers must be at least 1')
+    if options.workers > 1 and single_process:
+        parser.error(f'several workers need {single_process} (or use --workers 1)')
+    return options
+
+
+def single_process_backend(settings):
+    """What several workers would need instead of the configured backends, if anything.
+
+    Connections to one room land on different workers; they only see each
+    other's state and broadcasts through shared backends.
+    """
+    if getattr(settings, 'SYNCPLAY_ROOM_STATE_BACKEND', 'memory') == 'memory':
+        return 'SYNCPLAY_ROOM_STATE_BACKEND=redis'
+    layer = settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND', '')
+    if layer.endswith('InMemoryChannelLayer'):
+        return 'a shared channel layer, not InMemoryChannelLayer (set DEBUG=False for Redis)'
+    return None
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+    load_dotenv()
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'syncplay_backend.settings')
+
+    # Settings only: django.setup() would import daphne and build its
+    # reactor here, before the workers get to pick their event loop
+    from django.conf import settings
+    from django.utils.log import configure_logging
+    configure_logging(settings.LOGGING_CONFIG, settings.LOGGING)
+
+    return Supervisor(parse_args(argv)).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
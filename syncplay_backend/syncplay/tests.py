@@ -1,3 +1,1424 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import socket
+import tempfile
+import time
+import unittest
+import uuid
+import zlib
+from contextlib import redirect_stderr
+import warnings
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+
+from . import codec, protocol, room_cache
+from .clock import ClockSync, client_time_ms
+from .consumers import SyncPlayConsumer
+from .db import database_sync_to_async
+from .management.commands.cleanup_rooms import old_sessions, stale_rooms
+from .message_log import MessageLog, message_log
+from .models import Message, Room, RoomSession, User
+from .parsers import FastJSONParser
+from .presence import PresenceTracker, presence
+from .renderers import FastJSONRenderer
+from .repository import AsyncOrmRoomRepository, PooledRoomRepository, get_repository, join_room
+from .room_state import RedisRoomStateStore, RoomStateStore, room_states
+from .routing import websocket_urlpatterns
+from .serve import bind_socket, parse_args
+from .throttle import JoinBatcher, JoinGate, SeekCoalescer, TokenBucket, get_control_rate_policy
+from .views import message_page, messages_after, messages_before
+
+try:
+    import fakeredis
+    import fakeredis.aioredis
+except ImportError:
+    fakeredis = None
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class RoomQueryCountTests(TestCase):
+    """Serializing rooms must not cost a query per room"""
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(5):
+            room = Room.objects.create(name=f'Room {i}', host_id=uuid.uuid4())
+            for j in range(3):
+                User.objects.create(room=room, name=f'user{j}', is_host=(j == 0))
+        cls.room = room
+
+    def setUp(self):
+        cache.clear()
+
+    def test_list_rooms_query_count(self):
+        # Summaries with an annotated count: one query whatever the number of rooms
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('syncplay:list_rooms'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 5)
+        self.assertEqual([room['user_count'] for room in response.json()['rooms']], [3] * 5)
+        self.assertNotIn('users', response.json()['rooms'][0])
+
+    def test_get_room_query_count(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('syncplay:get_room', args=[self.room.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['room']['user_count'], 3)
+        self.assertEqual(len(response.json()['room']['users']), 3)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class RoomLobbyTests(TestCase):
+    def test_cursor_pages_skip_idle_rooms(self):
+        cache.clear()
+        rooms = [Room.objects.create(name=f'Room {i}', host_id=uuid.uuid4()) for i in range(5)]
+        Room.objects.filter(id=rooms[0].id).update(last_active_at=timezone.now() - timedelta(hours=2))
+
+        url = reverse('syncplay:list_rooms') + '?page_size=3'
+        seen = []
+        while url:
+            data = self.client.get(url).json()
+            seen += [room['id'] for room in data['rooms']]
+            url = data['next']
+        self.assertEqual(seen, [str(room.id) for room in reversed(rooms[1:])])
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class RoomCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create(name='Movie', host_id=uuid.uuid4())
+        self.host = User.objects.create(id=self.room.host_id, room=self.room, name='host', is_host=True)
+        self.url = reverse('syncplay:get_room', args=[self.room.id])
+
+    def tearDown(self):
+        # Write queued log entries while the test database still exists
+        message_log.flush()
+
+    def test_cached_room_is_served_without_queries(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response['ETag'], etag)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_playing_room_has_a_weak_etag(self):
+        Room.objects.filter(id=self.room.id).update(
+            is_playing=True, position_updated_at=timezone.now() - timedelta(seconds=5),
+        )
+        first = self.client.get(self.url)
+        second = self.client.get(self.url)
+        # Same tag while the extrapolated position moves on
+        self.assertTrue(first['ETag'].startswith('W/"'))
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertGreaterEqual(first.json()['room']['position'], 5)
+
+        strong = first['ETag'].removeprefix('W/')
+        for etag in (first['ETag'], strong, f'"other", {strong}'):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_control_invalidates_cached_room(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.post(
+            reverse('syncplay:control_video', args=[self.room.id]),
+            {'user_id': str(self.host.id), 'action': 'seek', 'position': 42},
+            content_type='application/json',
+        )
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['room']['position'], 42)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class MetricsViewTests(TestCase):
+    def test_metrics_are_staff_only(self):
+        url = reverse('syncplay:metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        accounts = get_user_model()
+        self.client.force_login(accounts.objects.create_user('viewer', password='x'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_login(accounts.objects.create_user('admin', password='x', is_staff=True))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('compression_bytes_saved', response.json())
+
+
+class QueryPlanTests(TestCase):
+    """The hot queries must be able to use their indexes instead of scanning"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.room = Room.objects.create(name='Movie', host_id=uuid.uuid4())
+        cls.cutoff = timezone.now() - timedelta(hours=24)
+
+    def assertUsesIndex(self, queryset, *index_names):
+        if connection.vendor == 'postgresql':
+            # Tiny test tables are cheaper to scan; only check that the index applies
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = queryset.explain()
+        self.assertTrue(any(name in plan for name in index_names), plan)
+
+    def test_room_messages(self):
+        self.assertUsesIndex(
+            message_page(Message.objects.filter(room=self.room), 50),
+            'syncplay_msg_room_ts_idx',
+        )
+
+    def test_room_messages_keyset_pages(self):
+        messages = Message.objects.filter(room=self.room)
+        self.assertUsesIndex(
+            message_page(messages_before(messages, self.cutoff, uuid.uuid4()), 50),
+            'syncplay_msg_room_ts_idx',
+        )
+        self.assertUsesIndex(
+            message_page(messages_after(messages, self.cutoff, uuid.uuid4()), 50, forward=True),
+            'syncplay_msg_room_ts_idx',
+        )
+
+    def test_cleanup_old_sessions(self):
+        self.assertUsesIndex(
+            old_sessions(self.cutoff, ['live-channel']),
+            'syncplay_session_activity_idx',
+        )
+
+    def test_cleanup_old_rooms(self):
+        self.assertUsesIndex(
+            stale_rooms(self.cutoff, [uuid.uuid4()]),
+            # Either range filter is selective enough for the planner
+            'syncplay_room_created_id_idx',
+            'syncplay_room_last_active_at',
+        )
+
+
+class CleanupRoomsTests(TestCase):
+    def setUp(self):
+        old = timezone.now() - timedelta(hours=48)
+        self.stale = []
+        for i in range(5):
+            room = Room.objects.create(name=f'Old {i}', host_id=uuid.uuid4())
+            user = User.objects.create(id=room.host_id, room=room, name='host', is_host=True)
+            Message.objects.create(room=room, user_id=user.id, message_type='play', data={})
+            RoomSession.objects.create(room=room, user_id=user.id, channel_name=f'old-{i}')
+            self.stale.append(room.id)
+        Room.objects.filter(id__in=self.stale).update(created_at=old, last_active_at=old)
+        User.objects.filter(room_id__in=self.stale).update(last_seen=old)
+        RoomSession.objects.filter(room_id__in=self.stale).update(last_activity=old)
+
+        self.fresh = Room.objects.create(name='New', host_id=uuid.uuid4())
+        host = User.objects.create(id=self.fresh.host_id, room=self.fresh, name='host', is_host=True)
+        Message.objects.create(room=self.fresh, user_id=host.id, message_type='play', data={})
+        RoomSession.objects.create(room=self.fresh, user_id=host.id, channel_name='fresh')
+
+    def test_batched_delete_removes_rooms_with_children(self):
+        stdout = io.StringIO()
+        call_command('cleanup_rooms', batch_size=2, pause=0, stdout=stdout)
+
+        # Five rooms in batches of two take three transactions
+        self.assertEqual(stdout.getvalue().count('Deleted 2 rooms'), 2)
+        self.assertIn('Deleted 1 rooms', stdout.getvalue())
+        self.assertFalse(Room.objects.filter(id__in=self.stale).exists())
+        self.assertFalse(Message.objects.filter(room_id__in=self.stale).exists())
+        self.assertFalse(RoomSession.objects.filter(room_id__in=self.stale).exists())
+        self.assertFalse(User.objects.filter(room_id__in=self.stale).exists())
+
+        self.assertEqual(list(Room.objects.values_list('id', flat=True)), [self.fresh.id])
+        self.assertEqual(Message.objects.filter(room=self.fresh).count(), 1)
+        self.assertEqual(RoomSession.objects.filter(room=self.fresh).count(), 1)
+        self.assertEqual(User.objects.filter(room=self.fresh).count(), 1)
+
+
+@override_settings(SYNCPLAY_MESSAGE_RETENTION_DAYS=30, SYNCPLAY_MESSAGE_RETENTION={'seek': 1})
+class ArchiveMessagesTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Movie', host_id=uuid.uuid4())
+        now = timezone.now()
+        self.old_seeks = [self.message('seek', now - timedelta(days=2, minutes=i)) for i in (1, 0)]
+        self.old_play = self.message('play', now - timedelta(days=40))
+        self.recent = [self.message('play', now - timedelta(days=2)), self.message('seek', now)]
+        self.expired = self.old_seeks + [self.old_play]
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        self.archive_dir = archive_dir.name
+
+    def message(self, message_type, timestamp):
+        return Message.objects.create(
+            room=self.room, user_id=uuid.uuid4(), message_type=message_type,
+            data={'position': 1}, timestamp=timestamp,
+        ).id
+
+    def archive(self, *args, **options):
+        stdout = io.StringIO()
+        call_command('archive_messages', *args, archive_dir=self.archive_dir, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def archived(self):
+        rows = {}
+        for name in sorted(os.listdir(self.archive_dir)):
+            with gzip.open(os.path.join(self.archive_dir, name), 'rt') as archive:
+                rows[name.split('-')[1]] = [json.loads(line) for line in archive]
+        return rows
+
+    def remaining(self):
+        return set(Message.objects.values_list('id', flat=True))
+
+    def test_per_type_retention(self):
+        self.archive(batch_size=1)
+        self.assertEqual(self.remaining(), set(self.recent))
+
+        archived = self.archived()
+        self.assertEqual(sorted(archived), ['play', 'seek'])
+        # Oldest first, one line per message
+        self.assertEqual([row['id'] for row in archived['seek']], [str(pk) for pk in self.old_seeks])
+        play = archived['play'][0]
+        self.assertEqual(play['id'], str(self.old_play))
+        self.assertEqual((play['room_id'], play['type'], play['data']), (str(self.room.id), 'play', {'position': 1}))
+
+    def test_dry_run_changes_nothing(self):
+        output = self.archive(dry_run=True)
+        self.assertIn("Would archive 2 'seek' messages", output)
+        self.assertIn("Would archive 1 'play' messages", output)
+        self.assertEqual(len(self.remaining()), 5)
+        self.assertEqual(os.listdir(self.archive_dir), [])
+
+    def test_no_archive_only_deletes(self):
+        self.archive(no_archive=True)
+        self.assertEqual(self.remaining(), set(self.recent))
+        self.assertEqual(os.listdir(self.archive_dir), [])
+
+    def failing_dumps(self, fail_at):
+        calls, real_dumps = [], codec.dumps
+
+        def dumps(obj):
+            calls.append(obj)
+            if len(calls) == fail_at:
+                raise OSError('disk full')
+            return real_dumps(obj)
+        return mock.patch('syncplay.management.commands.archive_messages.codec.dumps', side_effect=dumps)
+
+    def test_batch_is_deleted_only_once_written(self):
+        # Types go in MESSAGE_TYPES order: the play, then the first seek are
+        # written; the second seek's batch fails
+        with self.failing_dumps(fail_at=3), self.assertRaises(OSError):
+            self.archive(batch_size=1)
+        self.assertNotIn(self.old_play, self.remaining())
+        self.assertNotIn(self.old_seeks[0], self.remaining())
+        self.assertIn(self.old_seeks[1], self.remaining())
+        self.assertEqual([row['id'] for row in self.archived()['seek']], [str(self.old_seeks[0])])
+
+    def test_empty_archives_are_removed(self):
+        with self.failing_dumps(fail_at=1), self.assertRaises(OSError):
+            self.archive()
+        self.assertEqual(os.listdir(self.archive_dir), [])
+        self.assertEqual(len(self.remaining()), 5)
+
+        # Types with nothing expired leave no file either
+        self.archive()
+        self.assertEqual(sorted(self.archived()), ['play', 'seek'])
+
+    def test_retention_setting_is_validated(self):
+        from syncplay_backend.settings import parse_message_retention
+
+        self.assertEqual(parse_message_retention('seek=1, join = 30,'), {'seek': 1, 'join': 30})
+        for value in ('seek', 'seek=soon', '=3'):
+            with self.assertRaises(ImproperlyConfigured):
+                parse_message_retention(value)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class MessageHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.room = Room.objects.create(name='Movie', host_id=uuid.uuid4())
+        start = timezone.now() - timedelta(hours=1)
+        # Pairs of messages share a timestamp so the id has to break ties
+        Message.objects.bulk_create([
+            Message(
+                room=cls.room, user_id=uuid.uuid4(),
+                message_type='seek' if i % 3 else 'play',
+                data={'position': i}, timestamp=start + timedelta(seconds=i // 2),
+            )
+            for i in range(12)
+        ])
+        cls.url = reverse('syncplay:get_room_messages', args=[cls.room.id])
+        cls.ordered = [
+            str(pk) for pk in Message.objects.filter(room=cls.room).order_by('timestamp', 'id').values_list('id', flat=True)
+        ]
+
+    def ids(self, response):
+        return [message['id'] for message in response.json()['messages']]
+
+    def test_pages_backwards_and_forwards(self):
+        latest = self.client.get(self.url, {'limit': 5})
+        self.assertEqual(self.ids(latest), self.ordered[-5:])
+        self.assertTrue(latest.json()['has_more'])
+
+        seen = self.ids(latest)
+        cursor = latest.json()['before']
+        while True:
+            page = self.client.get(self.url, {'limit': 5, 'before': cursor}).json()
+            seen = [message['id'] for message in page['messages']] + seen
+            cursor = page['before']
+            if not page['has_more']:
+                break
+        self.assertEqual(seen, self.ordered)
+
+        first = self.client.get(self.url, {'limit': 4, 'before': latest.json()['before']})
+        forward = self.client.get(self.url, {'limit': 4, 'after': first.json()['after']})
+        self.assertEqual(self.ids(first), self.ordered[-9:-5])
+        self.assertEqual(self.ids(forward), self.ordered[-5:-1])
+
+    def test_type_filter(self):
+        response = self.client.get(self.url, {'type': 'play'})
+        self.assertEqual([message['type'] for message in response.json()['messages']], ['play'] * 4)
+
+    async def test_ndjson_export_streams_under_asgi(self):
+        # Batches smaller than the history, so the keyset continuation runs
+        with mock.patch('syncplay.views.EXPORT_BATCH_SIZE', 5), warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            response = await AsyncClient().get(self.url, {'export': 'ndjson', 'type': 'seek,play'})
+            # Iterated the way ASGIHandler sends a streaming body
+            body = b''.join([chunk async for chunk in response])
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['id'] for line in body.decode().splitlines()], self.ordered)
+        # A sync iterator would be read into memory whole, with this warning
+        self.assertFalse([w for w in caught if 'StreamingHttpResponse' in str(w.message)])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(self.url, {'before': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'limit': 0}).status_code, 400)
+
+
+REDIS_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer'}}
+MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+class DatabasePoolTests(TestCase):
+    @override_settings(SYNCPLAY_DB_CONN_MAX_AGE=60)
+    def test_pool_threads_keep_their_connection(self):
+        @database_sync_to_async
+        def close_at():
+            connection.ensure_connection()
+            return connection.settings_dict['CONN_MAX_AGE'], connection.close_at - time.monotonic()
+
+        async_to_sync(close_at)()  # Connects
+        # Request threads close after every request; the pool keeps its own
+        max_age, remaining = async_to_sync(close_at)()
+        self.assertEqual(max_age, 0)
+        self.assertGreater(remaining, 50)
+        # Counted from the connect, not pushed out by every call
+        self.assertLessEqual(async_to_sync(close_at)()[1], remaining)
+
+
+class ServeTests(SimpleTestCase):
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), 'needs SO_REUSEPORT')
+    def test_bind_socket_shares_the_port(self):
+        first = bind_socket('127.0.0.1', 0, 16, 30, reuse_port=True)
+        self.addCleanup(first.close)
+        port = first.getsockname()[1]
+        # A second worker binds the same port instead of failing
+        second = bind_socket('127.0.0.1', port, 16, 30, reuse_port=True)
+        self.addCleanup(second.close)
+        self.assertEqual(second.getsockname()[1], port)
+        self.assertTrue(first.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            self.assertEqual(first.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE), 30)
+
+    def assertRefused(self, argv):
+        with redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            parse_args(argv)
+
+    @override_settings(SYNCPLAY_ROOM_STATE_BACKEND='memory', CHANNEL_LAYERS=MEMORY_CHANNEL_LAYERS, SYNCPLAY_WORKERS=0)
+    def test_single_process_backends_allow_one_worker(self):
+        self.assertEqual(parse_args(['--workers', '1']).workers, 1)
+        self.assertRefused(['--workers', '2'])
+
+    @override_settings(SYNCPLAY_ROOM_STATE_BACKEND='memory', CHANNEL_LAYERS=MEMORY_CHANNEL_LAYERS, SYNCPLAY_WORKERS=0)
+    def test_single_process_backends_default_to_one_worker(self):
+        with mock.patch('syncplay.serve.os.cpu_count', return_value=8):
+            self.assertEqual(parse_args([]).workers, 1)
+        with override_settings(SYNCPLAY_WORKERS=3):
+            self.assertRefused([])
+
+    @override_settings(SYNCPLAY_ROOM_STATE_BACKEND='redis', CHANNEL_LAYERS=REDIS_CHANNEL_LAYERS, SYNCPLAY_WORKERS=0)
+    def test_shared_backends_default_to_one_worker_per_cpu(self):
+        with mock.patch('syncplay.serve.os.cpu_count', return_value=8):
+            self.assertEqual(parse_args([]).workers, 8)
+
+    @override_settings(SYNCPLAY_ROOM_STATE_BACKEND='redis', CHANNEL_LAYERS=MEMORY_CHANNEL_LAYERS)
+    def test_in_memory_channel_layer_refuses_workers(self):
+        self.assertRefused(['--workers', '2'])
+
+    @override_settings(SYNCPLAY_ROOM_STATE_BACKEND='redis', CHANNEL_LAYERS=REDIS_CHANNEL_LAYERS)
+    def test_shared_backends_allow_workers(self):
+        options = parse_args(['--workers', '4', '--backlog', '64', '--keepalive', '0'])
+        self.assertEqual((options.workers, options.backlog, options.keepalive), (4, 64, 0))
+
+
+class FakeRedisRoomStateStore(RedisRoomStateStore):
+    """A worker's store, talking to a fake Redis server shared with other workers"""
+
+    def __init__(self, server):
+        super().__init__(redis_url='redis://fake', flush_interval=60)
+        self.server = server
+        self._redis = fakeredis.FakeRedis(server=server)
+        self.flusher.start = lambda: None  # Tests flush by hand
+
+    @property
+    def async_redis(self):
+        return fakeredis.aioredis.FakeRedis(server=self.server)
+
+
+@unittest.skipIf(fakeredis is None, 'needs fakeredis')
+class RedisRoomStateStoreTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create(name='Movie', host_id=uuid.uuid4())
+        self.room_id = str(self.room.id)
+        server = fakeredis.FakeServer()
+        self.store = FakeRedisRoomStateStore(server)
+        self.other = FakeRedisRoomStateStore(server)
+        async_to_sync(self.store.acquire)(self.room, 'channel-a')
+
+    def hget(self, field):
+        return self.store.redis.hget(self.store.state_key(self.room_id), field)
+
+    def dirty(self):
+        return {room_id.decode() for room_id in self.store.redis.smembers(RedisRoomStateStore.DIRTY_KEY)}
+
+    def test_concurrent_updates_lose_no_versions(self):
+        async def race():
+            # Two workers updating one room, interleaved on the event loop
+            return await asyncio.gather(*[
+                store.update(self.room_id, position=float(i))
+                for i in range(10) for store in (self.store, self.other)
+            ])
+
+        states = async_to_sync(race)()
+        self.assertEqual(sorted(state.version for state in states), list(range(1, 21)))
+        self.assertEqual(int(self.hget('version')), 20)
+        self.assertEqual(self.dirty(), {self.room_id})
+
+    def test_failed_flush_puts_claimed_rooms_back(self):
+        async_to_sync(self.store.update)(self.room_id, position=42.0)
+        with mock.patch('syncplay.room_state.write_room_fields', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.other.flush()
+        self.assertEqual(self.dirty(), {self.room_id})
+
+        self.other.flush()
+        self.assertEqual(self.dirty(), set())
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.current_position.total_seconds(), 42.0)
+        self.assertEqual(int(self.hget('db_version')), self.room.version)
+
+    def test_refresh_adopts_the_saved_room(self):
+        async_to_sync(self.store.update)(self.room_id, position=5.0)
+        self.assertTrue(self.room.versioned_update(current_video_title='Saved elsewhere'))
+        self.room.refresh_from_db()
+
+        self.other.refresh(self.room)
+        state = async_to_sync(self.store.get)(self.room_id)
+        self.assertEqual(state.video_title, 'Saved elsewhere')
+        self.assertEqual(state.version, 2)
+        self.assertEqual(state.db_version, self.room.version)
+        # The saved row wins over the pending change
+        self.assertEqual(self.dirty(), set())
+
+    def ttl(self):
+        return self.store.redis.ttl(self.store.state_key(self.room_id))
+
+    def test_last_release_expires_the_room(self):
+        async_to_sync(self.other.acquire)(self.room, 'channel-b')
+        async_to_sync(self.store.release)(self.room_id, 'channel-a')
+        self.assertEqual(self.ttl(), -1)
+        async_to_sync(self.other.release)(self.room_id, 'channel-b')
+        self.assertGreater(self.ttl(), 0)
+
+        # A reconnect keeps it
+        async_to_sync(self.store.acquire)(self.room, 'channel-c')
+        self.assertEqual(self.ttl(), -1)
+
+    def test_join_during_release_keeps_the_room(self):
+        import redis.asyncio.client
+        scard = redis.asyncio.client.Pipeline.scard
+        joined = []
+
+        async def scard_then_join(pipe, key):
+            count = await scard(pipe, key)
+            if not joined:
+                # Another worker's join lands after the count, before the expire
+                joined.append(await self.other.acquire(self.room, 'channel-b'))
+            return count
+
+        with mock.patch.object(redis.asyncio.client.Pipeline, 'scard', scard_then_join):
+            async_to_sync(self.store.release)(self.room_id, 'channel-a')
+        self.assertEqual(self.ttl(), -1)
+        self.assertEqual(self.store.redis.smembers(self.store.members_key(self.room_id)), {b'channel-b'})
+        self.assertIsNotNone(async_to_sync(self.other.update)(self.room_id, position=3.0))
+
+    def test_rebase_skips_rooms_changed_since_the_flush_read(self):
+        Room.objects.filter(id=self.room.id).update(current_video_title='Newer', version=5)
+        newer = Room.objects.get(id=self.room.id)
+
+        async_to_sync(self.store.update)(self.room_id, position=1.0)
+        self.store._rebase(newer, seen_version=0)
+        self.assertEqual(int(self.hget('version')), 1)
+        self.assertIsNone(async_to_sync(self.store.get)(self.room_id).video_title)
+
+        self.store._rebase(newer, seen_version=1)
+        state = async_to_sync(self.store.get)(self.room_id)
+        self.assertEqual((state.version, state.db_version, state.video_title), (2, 5, 'Newer'))
+
+
+class PresenceTrackerTests(TestCase):
+    def setUp(self):
+        self.rooms = [Room.objects.create(name=name, host_id=uuid.uuid4()) for name in ('a', 'b')]
+        self.long_ago = timezone.now() - timedelta(days=2)
+        Room.objects.update(last_active_at=self.long_ago)
+        for i, room in enumerate(self.rooms):
+            RoomSession.objects.create(room=room, user_id=uuid.uuid4(), channel_name=f'channel-{i}')
+        RoomSession.objects.update(last_activity=self.long_ago)
+
+    def tracker(self, redis_url=None):
+        tracker = PresenceTracker(sweep_interval=60, redis_url=redis_url)
+        tracker.flusher.start = lambda: None
+        return tracker
+
+    def test_sweep_writes_activity_in_bulk(self):
+        tracker = self.tracker()
+        tracker.touch('channel-0', self.rooms[0].id)
+        seen_at = tracker.last_activity('channel-0')
+        with CaptureQueriesContext(connection) as queries:
+            tracker.sweep()
+        # Load sessions, one bulk UPDATE of sessions, one UPDATE of rooms
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(RoomSession.objects.get(channel_name='channel-0').last_activity, seen_at)
+        self.assertEqual(RoomSession.objects.get(channel_name='channel-1').last_activity, self.long_ago)
+        self.assertEqual(
+            dict(Room.objects.values_list('name', 'last_active_at')),
+            {'a': seen_at, 'b': self.long_ago},
+        )
+
+        # Nothing seen since, nothing written
+        with self.assertNumQueries(0):
+            tracker.sweep()
+
+    def test_active_channels_and_rooms(self):
+        tracker = self.tracker()
+        tracker.touch('channel-0', self.rooms[0].id)
+        since = timezone.now() - timedelta(minutes=1)
+        self.assertEqual(tracker.active_channels(since), {'channel-0'})
+        self.assertEqual(tracker.active_room_ids(since), {str(self.rooms[0].id)})
+        self.assertEqual(tracker.active_channels(timezone.now() + timedelta(minutes=1)), set())
+
+        tracker.forget('channel-0')
+        self.assertEqual(tracker.active_channels(since), set())
+        self.assertIsNone(tracker.last_activity('channel-0'))
+        with self.assertNumQueries(0):
+            tracker.sweep()
+
+    @unittest.skipIf(fakeredis is None, 'needs fakeredis')
+    def test_redis_is_shared_and_pruned(self):
+        server = fakeredis.FakeServer()
+        trackers = []
+        for _ in range(2):
+            tracker = self.tracker(redis_url='redis://fake')
+            tracker._redis = fakeredis.FakeRedis(server=server)
+            trackers.append(tracker)
+        this, other = trackers
+        since = timezone.now() - timedelta(minutes=1)
+
+        this.touch('channel-0', self.rooms[0].id)
+        this.touch('channel-1', self.rooms[1].id)
+        this.sweep()
+        # Another process sees what this one swept
+        self.assertEqual(other.active_channels(since), {'channel-0', 'channel-1'})
+        self.assertEqual(other.active_room_ids(since), {str(room.id) for room in self.rooms})
+
+        # A forgotten channel leaves Redis on the next sweep
+        this.forget('channel-1')
+        self.assertIn('channel-1', other.active_channels(since))
+        this.sweep()
+        self.assertEqual(other.active_channels(since), {'channel-0'})
+
+        other.prune(timezone.now() + timedelta(minutes=1))
+        self.assertEqual(other.active_room_ids(since), set())
+        self.assertEqual(this._redis.keys('syncplay:presence:*'), [])
+
+
+class MessageLogTests(TestCase):
+    """Bounded message queue, flushed by hand"""
+
+    def setUp(self):
+        self.room = Room.objects.create(name='Movie', host_id=uuid.uuid4())
+
+    def message_log(self, policy, max_size=3):
+        log = MessageLog(max_size=max_size, batch_size=100, flush_interval=60, policy=policy)
+        log.flusher.start = lambda: None
+        return log
+
+    def log(self, log, *positions):
+        return [log.log(self.room.id, uuid.uuid4(), 'seek', {'position': p}) for p in positions]
+
+    def written(self):
+        return sorted(m.data['position'] for m in Message.objects.filter(room=self.room))
+
+    def test_unknown_policy_is_rejected(self):
+        with self.assertRaises(ValueError):
+            MessageLog(policy='drop_everything')
+
+    def test_drop_oldest_keeps_the_latest(self):
+        log = self.message_log('drop_oldest')
+        self.assertEqual(self.log(log, 0, 1, 2, 3, 4), [True] * 5)
+        self.assertEqual((len(log), log.dropped), (3, 2))
+        log.flush()
+        self.assertEqual(self.written(), [2, 3, 4])
+        self.assertEqual(log.dropped, 0)
+
+    def test_drop_newest_keeps_the_backlog(self):
+        log = self.message_log('drop_newest')
+        self.assertEqual(self.log(log, 0, 1, 2, 3, 4), [True, True, True, False, False])
+        self.assertEqual((len(log), log.dropped), (3, 2))
+        log.flush()
+        self.assertEqual(self.written(), [0, 1, 2])
+
+    def test_stop_flushes_pending_messages(self):
+        log = self.message_log('drop_oldest')
+        self.log(log, 0, 1)
+        log.close()
+        self.assertEqual(len(log), 0)
+        self.assertEqual(self.written(), [0, 1])
+
+    def test_failed_write_puts_the_batch_back(self):
+        log = self.message_log('drop_oldest')
+        self.log(log, 0, 1)
+        with mock.patch.object(Message.objects, 'bulk_create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                log.flush()
+        self.assertEqual(len(log), 2)
+        log.flush()
+        self.assertEqual(self.written(), [0, 1])
+
+    def test_failed_room_lookup_puts_the_batch_back(self):
+        log = self.message_log('drop_oldest')
+        self.log(log, 0, 1)
+        with mock.patch.object(Room.objects, 'filter', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                log.flush()
+        self.assertEqual(len(log), 2)
+
+    def assertRequeuedWithin(self, policy, expected):
+        # Two more messages arrive while the full batch is being written
+        log = self.message_log(policy)
+        self.log(log, 0, 1, 2)
+
+        def fail(batch):
+            self.log(log, 3, 4)
+            raise DatabaseError
+        with mock.patch.object(Message.objects, 'bulk_create', side_effect=fail):
+            with self.assertRaises(DatabaseError):
+                log.flush()
+        self.assertEqual((len(log), log.dropped), (3, 2))
+        log.flush()
+        self.assertEqual(self.written(), expected)
+
+    def test_requeue_respects_drop_oldest(self):
+        self.assertRequeuedWithin('drop_oldest', [2, 3, 4])
+
+    def test_requeue_respects_drop_newest(self):
+        self.assertRequeuedWithin('drop_newest', [0, 1, 2])
+
+
+class RoomStateStoreTests(TestCase):
+    """Write-behind of in-memory playback state, flushed by hand"""
+
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create(name='Movie', host_id=uuid.uuid4())
+        self.room_id = str(self.room.id)
+        self.store = RoomStateStore(flush_interval=60)
+        self.store.flusher.start = lambda: None
+        self.state = async_to_sync(self.store.acquire)(self.room, 'channel-a')
+
+    def update(self, **changes):
+        return async_to_sync(self.store.update)(self.room_id, **changes)
+
+    def test_changes_coalesce_into_one_update(self):
+        for position in (1.0, 2.0, 3.0):
+            self.update(position=position)
+        with CaptureQueriesContext(connection) as queries:
+            self.store.flush()
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.current_position.total_seconds(), 3.0)
+        self.assertEqual((self.room.version, self.state.db_version), (1, 1))
+
+        # Nothing dirty, nothing written
+        with self.assertNumQueries(0):
+            self.store.flush()
+
+    def test_released_room_is_dropped_after_its_flush(self):
+        self.update(position=7.0)
+        async_to_sync(self.store.release)(self.room_id, 'channel-a')
+        self.assertIsNotNone(async_to_sync(self.store.get)(self.room_id))
+        self.store.flush()
+        self.assertIsNone(async_to_sync(self.store.get)(self.room_id))
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.current_position.total_seconds(), 7.0)
+
+    def test_failed_write_marks_rooms_dirty_again(self):
+        self.update(position=7.0)
+        with mock.patch('syncplay.room_state.write_room_fields', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.store.flush()
+        self.assertIn(self.room_id, self.store._dirty)
+        self.store.flush()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.current_position.total_seconds(), 7.0)
+
+    def test_older_row_is_written_over(self):
+        # Another writer moved the row on, with a change older than ours
+        Room.objects.filter(id=self.room.id).update(
+            version=3, current_video_title='Older',
+            position_updated_at=timezone.now() - timedelta(minutes=1),
+        )
+        self.update(position=9.0)
+        self.store.flush()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.current_position.total_seconds(), 9.0)
+        self.assertIsNone(self.room.current_video_title)
+        self.assertEqual((self.room.version, self.state.db_version), (4, 4))
+
+    def test_newer_row_supersedes_the_pending_change(self):
+        self.update(position=9.0)
+        version = self.state.version
+        Room.objects.filter(id=self.room.id).update(
+            version=3, current_video_title='Newer', current_position=timedelta(seconds=30),
+            position_updated_at=timezone.now() + timedelta(minutes=1),
+        )
+        self.store.flush()
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.version, self.room.current_video_title), (3, 'Newer'))
+        # The state reloads from the row and clients see a new version
+        self.assertEqual((self.state.video_title, self.state.db_version), ('Newer', 3))
+        self.assertEqual(self.state.version, version + 1)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class VersionedUpdateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create(name='Movie', host_id=uuid.uuid4())
+        self.host = User.objects.create(id=self.room.host_id, room=self.room, name='host', is_host=True)
+        # Someone else has written the row twice since self.room was loaded
+        Room.objects.filter(id=self.room.id).update(version=2, current_video_title='Theirs')
+
+    def tearDown(self):
+        message_log.flush()
+
+    def test_stale_expected_version_is_rejected(self):
+        self.assertFalse(self.room.versioned_update(0, current_video_title='Mine'))
+        self.assertEqual(self.room.version, 2)
+        self.assertEqual(Room.objects.get(id=self.room.id).current_video_title, 'Theirs')
+
+    def test_write_without_version_rebases(self):
+        self.assertTrue(self.room.versioned_update(current_video_title='Mine'))
+        row = Room.objects.get(id=self.room.id)
+        self.assertEqual((row.version, row.current_video_title), (3, 'Mine'))
+        self.assertEqual(self.room.version, 3)
+
+    def post(self, name, data):
+        return self.client.post(
+            reverse(f'syncplay:{name}', args=[self.room.id]),
+            {'user_id': str(self.host.id), **data},
+            content_type='application/json',
+        )
+
+    def test_control_conflict(self):
+        response = self.post('control_video', {'action': 'seek', 'position': 10, 'db_version': 1})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['room']['db_version'], 2)
+
+        response = self.post('control_video', {'action': 'seek', 'position': 10, 'db_version': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['room']['db_version'], 3)
+
+    def test_change_video_conflict(self):
+        video = {'video_url': 'https://example.com/v.mp4', 'video_title': 'Mine'}
+        response = self.post('change_video', {**video, 'db_version': 0})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['room']['current_video_title'], 'Theirs')
+        self.assertEqual(self.post('change_video', video).status_code, 200)
+
+
+def installed_codecs():
+    codecs = []
+    for name in ('json', 'orjson', 'msgspec'):
+        try:
+            codecs.append(codec.load_codec(name))
+        except ImportError:
+            pass
+    return codecs
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class JSONCodecTests(TestCase):
+    data = {
+        'room': {'id': uuid.UUID('12345678-1234-5678-1234-567812345678'), 'name': 'Café \u2028 night \u2029'},
+        'position': 12.5, 'count': 3, 'is_playing': False, 'video': None, 'rate': Decimal('1.25'),
+        'users': [{'name': '名前'}],
+    }
+
+    def render(self, codec_impl, accepted_media_type='application/json'):
+        with mock.patch.object(codec, 'codec', codec_impl):
+            return FastJSONRenderer().render(self.data, accepted_media_type, {})
+
+    def test_codecs_render_like_drf(self):
+        expected = JSONRenderer().render(self.data, 'application/json', {})
+        for codec_impl in installed_codecs():
+            with self.subTest(codec=codec_impl.name):
+                self.assertEqual(self.render(codec_impl), expected)
+
+    def test_line_separators_are_escaped(self):
+        for codec_impl in installed_codecs():
+            with self.subTest(codec=codec_impl.name):
+                rendered = self.render(codec_impl)
+                self.assertIn(b'\\u2028 night \\u2029', rendered)
+                self.assertNotIn('\u2028'.encode(), rendered)
+                self.assertEqual(json.loads(rendered)['room']['name'], self.data['room']['name'])
+
+    def test_indent_falls_back_to_drf(self):
+        expected = JSONRenderer().render(self.data, 'application/json; indent=2', {})
+        self.assertIn(b'\n  ', expected)
+        for codec_impl in installed_codecs():
+            with self.subTest(codec=codec_impl.name):
+                self.assertEqual(self.render(codec_impl, 'application/json; indent=2'), expected)
+
+    def test_malformed_json_is_a_parse_error(self):
+        for codec_impl in installed_codecs():
+            with self.subTest(codec=codec_impl.name), mock.patch.object(codec, 'codec', codec_impl):
+                self.assertEqual(FastJSONParser().parse(io.BytesIO('{"name": "Café"}'.encode())), {'name': 'Café'})
+                with self.assertRaises(ParseError):
+                    FastJSONParser().parse(io.BytesIO(b'{"name": '))
+                response = self.client.post(
+                    reverse('syncplay:create_room'), '{"room_name": ', content_type='application/json',
+                )
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('JSON parse error', response.json()['detail'])
+
+
+@unittest.skipIf(protocol.msgpack is None, 'msgpack is not installed')
+class ProtocolTests(SimpleTestCase):
+    def setUp(self):
+        protocol.encode_frame.cache_clear()
+
+    def test_negotiate_takes_the_clients_first_supported_protocol(self):
+        self.assertEqual(
+            protocol.negotiate(['v2.syncplay', protocol.COMPACT_DEFLATE_PROTOCOL, protocol.JSON_PROTOCOL]),
+            protocol.COMPACT_DEFLATE_PROTOCOL,
+        )
+        self.assertIsNone(protocol.negotiate(['v2.syncplay']))
+        self.assertIsNone(protocol.negotiate(None))
+        with mock.patch.object(protocol, 'msgpack', None):
+            self.assertEqual(
+                protocol.negotiate([protocol.COMPACT_PROTOCOL, protocol.JSON_DEFLATE_PROTOCOL]),
+                protocol.JSON_DEFLATE_PROTOCOL,
+            )
+
+    def test_compact_frames_round_trip(self):
+        message = {'type': 'seek', 'data': {'position': 4.5}, 'userId': 'u'}
+        frame = protocol.encode_compact(message)
+        self.assertEqual(protocol.msgpack.unpackb(frame), [5, {'position': 4.5}, {'userId': 'u'}])
+        self.assertEqual(protocol.decode_compact(frame), message)
+
+    def test_decode_compact_fills_in_defaults(self):
+        message = protocol.decode_compact(protocol.msgpack.packb([99, None]))
+        self.assertEqual(message, {'type': 99, 'data': {}})
+
+    def test_decode_compact_rejects_malformed_frames(self):
+        for payload in (b'\xc1', protocol.msgpack.packb({'type': 'seek'}), protocol.msgpack.packb([1, 2, 3, 4])):
+            with self.assertRaises(protocol.ProtocolError):
+                protocol.decode_compact(payload)
+
+    def test_decompress_limits(self):
+        self.assertEqual(protocol.decompress(zlib.compress(b'{"type": "seek"}')), b'{"type": "seek"}')
+        with self.assertRaisesMessage(protocol.ProtocolError, 'Invalid deflate frame'):
+            protocol.decompress(b'\x78garbage')
+        bomb = zlib.compress(b' ' * (protocol.MAX_DECOMPRESSED_SIZE + 1))
+        with self.assertRaisesMessage(protocol.ProtocolError, 'too large'):
+            protocol.decompress(bomb)
+
+    def test_binary_frames_need_the_compact_protocol(self):
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decode(protocol.JSON_PROTOCOL, bytes_data=b'[3, {}]')
+        deflated = zlib.compress(codec.dumps({'type': 'play', 'data': {}}).encode())
+        self.assertEqual(protocol.decode(protocol.JSON_DEFLATE_PROTOCOL, bytes_data=deflated)['type'], 'play')
+
+    def test_json_frames_skip_the_other_encodings(self):
+        text = codec.dumps({'type': 'play', 'data': {'position': 1}})
+        with mock.patch.object(protocol, 'encode_compact') as encode_compact, \
+                mock.patch.object(protocol, 'compress') as compress:
+            self.assertEqual(protocol.encode_frame(text, protocol.JSON_PROTOCOL), text)
+            self.assertEqual(protocol.encode_frame(text, None), text)
+        encode_compact.assert_not_called()
+        compress.assert_not_called()
+
+    @override_settings(SYNCPLAY_COMPRESSION_THRESHOLD=16)
+    def test_variants_are_built_once_on_demand(self):
+        message = {'type': 'room_update', 'data': {'users': ['someone'] * 20}}
+        text = codec.dumps(message)
+        with mock.patch.object(protocol, 'encode_compact', wraps=protocol.encode_compact) as encode_compact:
+            for _ in range(3):
+                compact = protocol.encode_frame(text, protocol.COMPACT_PROTOCOL)
+                deflated = protocol.encode_frame(text, protocol.COMPACT_DEFLATE_PROTOCOL)
+        self.assertEqual(encode_compact.call_count, 1)
+        self.assertEqual(protocol.decode_compact(compact), message)
+        self.assertEqual(zlib.decompress(deflated), compact)
+        self.assertEqual(zlib.decompress(protocol.encode_frame(text, protocol.JSON_DEFLATE_PROTOCOL)), text.encode())
+
+
+    async def test_broadcast_frame_sends_each_connection_its_protocol(self):
+        message = {'type': 'play', 'data': {'position': 1}}
+        event = {'type': 'broadcast_frame', 'text': codec.dumps(message), 'user_id': 'sender', 'exclude_sender': True}
+        sent = {}
+        for subprotocol in (None, protocol.COMPACT_PROTOCOL, protocol.JSON_DEFLATE_PROTOCOL):
+            consumer = SyncPlayConsumer()
+            consumer.user_id, consumer.subprotocol = 'receiver', subprotocol
+            consumer.compact = protocol.is_compact(subprotocol)
+            consumer.deflate = protocol.is_deflate(subprotocol)
+            consumer.send = mock.AsyncMock()
+            await consumer.broadcast_frame(event)
+            sent[subprotocol] = consumer.send.call_args.kwargs
+        self.assertEqual(sent[None], {'text_data': event['text']})
+        self.assertEqual(protocol.decode_compact(sent[protocol.COMPACT_PROTOCOL]['bytes_data']), message)
+        # Too small to be worth deflating
+        self.assertEqual(sent[protocol.JSON_DEFLATE_PROTOCOL], {'text_data': event['text']})
+
+
+class JoinRoomTests(TransactionTestCase):
+    """The join transaction, run on the database pool like the consumer does"""
+
+    def setUp(self):
+        self.room = Room.objects.create(name='Movie', host_id=uuid.uuid4())
+        self.user_id = uuid.uuid4()
+
+    def join(self, user_id, name, room_id=None, channel_name=None):
+        return async_to_sync(join_room)(
+            room_id or self.room.id, channel_name or f'channel-{uuid.uuid4()}', user_id, name
+        )
+
+    def test_first_joiner_becomes_host(self):
+        room, user, data = self.join(str(self.user_id), 'alice')
+        self.assertEqual((room.id, user.id, user.is_host), (self.room.id, self.user_id, True))
+        self.assertEqual([u['name'] for u in data['users']], ['alice'])
+        self.assertFalse(self.join(str(uuid.uuid4()), 'bob')[1].is_host)
+        self.assertEqual(RoomSession.objects.filter(room=self.room).count(), 2)
+
+    def test_concurrent_joins_elect_one_host(self):
+        async def join_all():
+            return await asyncio.gather(*(
+                join_room(self.room.id, f'channel-{i}', str(uuid.uuid4()), f'user-{i}') for i in range(6)
+            ))
+        users = [user for _, user, _ in async_to_sync(join_all)()]
+        self.assertEqual(sum(user.is_host for user in users), 1)
+        self.assertEqual(User.objects.filter(room=self.room, is_host=True).count(), 1)
+
+    def test_rejoin_accepts_any_spelling_of_the_id(self):
+        self.join(str(self.user_id), 'alice')
+        for spelling in (str(self.user_id).upper(), self.user_id.hex, f'{{{self.user_id}}}'):
+            room, user, data = self.join(spelling, 'alice')
+            self.assertEqual(user.id, self.user_id)
+        self.assertEqual(User.objects.filter(room=self.room).count(), 1)
+        self.assertEqual(RoomSession.objects.filter(room=self.room).count(), 4)
+
+    def test_name_taken(self):
+        self.join(str(self.user_id), 'alice')
+        self.assertEqual(self.join(str(uuid.uuid4()), 'alice'), (None, None, "User name already taken"))
+
+    def test_invalid_user_id(self):
+        self.assertEqual(self.join('not-a-uuid', 'alice'), (None, None, "Invalid user ID"))
+        self.assertFalse(User.objects.exists())
+
+    def test_room_not_found(self):
+        self.assertEqual(self.join(str(self.user_id), 'alice', room_id=uuid.uuid4()), (None, None, "Room not found"))
+        self.assertFalse(RoomSession.objects.exists())
+
+
+class RoomRepositoryTests(TransactionTestCase):
+    """Both SYNCPLAY_DB_ACCESS modes behave the same"""
+
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create(name='Movie', host_id=uuid.uuid4())
+        self.host = User.objects.create(id=self.room.host_id, room=self.room, name='host', is_host=True)
+        RoomSession.objects.create(room=self.room, user_id=self.host.id, channel_name='channel-host')
+
+    def test_get_repository(self):
+        for access, repository in (('pool', PooledRoomRepository), ('async_orm', AsyncOrmRoomRepository)):
+            with self.subTest(access=access), override_settings(SYNCPLAY_DB_ACCESS=access):
+                self.assertIs(type(get_repository()), repository)
+        with override_settings(SYNCPLAY_DB_ACCESS='threads'), self.assertRaises(ValueError):
+            get_repository()
+
+    def assert_repository_works(self, access):
+        with override_settings(SYNCPLAY_DB_ACCESS=access):
+            repository = get_repository()
+        guest = User.objects.create(room=self.room, name='guest')
+        cache.set(room_cache.room_key(self.room.id), 'stale')
+        cache.set(room_cache.LOBBY_GENERATION_KEY, 3, None)
+
+        data = async_to_sync(repository.room_to_dict)(self.room)
+        self.assertEqual(sorted(u['name'] for u in data['users']), ['guest', 'host'])
+
+        async_to_sync(repository.remove_user)(guest)
+        self.assertFalse(User.objects.filter(id=guest.id).exists())
+        self.assertIsNone(cache.get(room_cache.room_key(self.room.id)))
+        self.assertEqual(cache.get(room_cache.LOBBY_GENERATION_KEY), 4)
+
+        async_to_sync(repository.remove_session)('channel-host')
+        self.assertFalse(RoomSession.objects.exists())
+
+    def test_pool(self):
+        self.assert_repository_works('pool')
+
+    def test_async_orm(self):
+        self.assert_repository_works('async_orm')
+
+
+class ConsumerTests(TransactionTestCase):
+    """Whole WebSocket sessions against the in-memory channel layer"""
+
+    def setUp(self):
+        self.room = Room.objects.create(name='Movie', host_id=uuid.uuid4())
+        self.room_id = str(self.room.id)
+        self.communicators = []
+
+    def tearDown(self):
+        message_log.flush()
+        room_states.flush()
+        presence.sweep()
+
+    async def disconnect_all(self):
+        for communicator in self.communicators:
+            await communicator.disconnect()
+
+    async def connect(self, subprotocols=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/room/{self.room_id}/', subprotocols=subprotocols,
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.communicators.append(communicator)
+        return communicator
+
+    async def join(self, communicator, name):
+        await communicator.send_json_to({'type': 'join', 'userId': str(uuid.uuid4()), 'data': {'userName': name}})
+        while True:
+            message = await communicator.receive_json_from()
+            if message['type'] == 'room_update':
+                return message
+
+    async def receive_until(self, communicator, message_type):
+        while True:
+            message = await communicator.receive_json_from()
+            if message['type'] == message_type:
+                return message
+
+    async def test_control_messages_need_a_join(self):
+        try:
+            stranger = await self.connect()
+            for message_type in ('play', 'pause', 'seek', 'video_changed'):
+                await stranger.send_json_to({'type': message_type, 'data': {'position': 5}})
+                message = await stranger.receive_json_from()
+                self.assertEqual(message, {'type': 'error', 'data': {'error': 'Join the room first'}})
+            self.assertIsNone(await room_states.get(self.room_id))
+
+            # The next joiner sees the room untouched
+            member = await self.connect()
+            room = (await self.join(member, 'alice'))['data']
+            self.assertEqual((room['position'], room['is_playing']), (0, False))
+        finally:
+            await self.disconnect_all()
+
+    async def test_stranger_cannot_replace_a_pending_seek(self):
+        try:
+            member, stranger = await self.connect(), await self.connect()
+            await self.join(member, 'alice')
+            await member.send_json_to({'type': 'seek', 'data': {'position': 10}})
+            await stranger.send_json_to({'type': 'seek', 'data': {'position': 99}})
+            self.assertEqual((await stranger.receive_json_from())['data']['error'], 'Join the room first')
+
+            # The stranger sits in the room group, so it hears the member's seek
+            seek = await self.receive_until(stranger, 'seek')
+            self.assertEqual(seek['data']['position'], 10)
+            self.assertEqual((await room_states.get(self.room_id)).position, 10)
+        finally:
+            await self.disconnect_all()
+
+
+    async def test_sender_gets_the_version_of_its_change(self):
+        try:
+            alice = await self.connect([protocol.JSON_PROTOCOL])
+            bob = await self.connect()
+            await self.join(alice, 'alice')
+            await self.receive_until(alice, 'user_joined')
+            await self.join(bob, 'bob')
+            # Both hear bob's join
+            version = (await self.receive_until(alice, 'user_joined'))['version']
+            await self.receive_until(bob, 'user_joined')
+
+            for message_type in ('play', 'pause', 'seek', 'video_changed'):
+                await alice.send_json_to({'type': message_type, 'data': {'position': 3}, 'videoUrl': 'v', 'videoTitle': 't'})
+                ack = await self.receive_until(alice, 'sync')
+                delta = await self.receive_until(bob, message_type)
+                self.assertEqual(ack['data']['version'], version + 1)
+                self.assertEqual(delta['version'], version + 1)
+                version += 1
+
+            # Without a subprotocol there is no acknowledgement
+            await bob.send_json_to({'type': 'play', 'data': {'position': 1}})
+            self.assertEqual((await self.receive_until(alice, 'play'))['version'], version + 1)
+            self.assertTrue(await bob.receive_nothing())
+        finally:
+            await self.disconnect_all()
+
+    async def test_sync_answers_gaps_with_a_snapshot(self):
+        try:
+            stranger = await self.connect()
+            await stranger.send_json_to({'type': 'sync', 'data': {'version': 0}})
+            self.assertEqual((await stranger.receive_json_from())['data']['error'], 'Join the room before syncing')
+
+            alice = await self.connect([protocol.JSON_PROTOCOL])
+            await self.join(alice, 'alice')
+            await alice.send_json_to({'type': 'play', 'data': {'position': 8}})
+            version = (await self.receive_until(alice, 'sync'))['data']['version']
+
+            await alice.send_json_to({'type': 'sync', 'data': {'version': version}})
+            self.assertEqual(await self.receive_until(alice, 'sync'), {'type': 'sync', 'data': {'version': version}})
+
+            await alice.send_json_to({'type': 'sync', 'data': {'version': version - 1}})
+            snapshot = await self.receive_until(alice, 'room_update')
+            self.assertEqual(snapshot['data']['version'], version)
+            self.assertTrue(snapshot['data']['is_playing'])
+            self.assertEqual(int(snapshot['data']['position']), 8)
+        finally:
+            await self.disconnect_all()
+
+
+class ClockSyncTests(SimpleTestCase):
+    def test_sample_offset_and_rtt(self):
+        clock = ClockSync()
+        # 30ms round trip, 10ms of it spent on the server; client clock 90ms behind
+        self.assertTrue(clock.add_sample(1000, 1100, 1110, 1030))
+        self.assertEqual(clock.to_dict(), {'offset': -90, 'rtt': 20, 'jitter': 0.0, 'samples': 1})
+
+    def test_later_samples_are_smoothed(self):
+        clock = ClockSync()
+        clock.add_sample(1000, 1100, 1110, 1030)
+        clock.add_sample(2000, 2090, 2100, 2030)  # offset -80, rtt 20
+        self.assertEqual(clock.offset, -90 + 10 * ClockSync.SMOOTHING)
+        self.assertEqual(clock.rtt, 20)
+        self.assertEqual(clock.jitter, 10 * ClockSync.SMOOTHING)
+        self.assertEqual(clock.samples, 2)
+
+    def test_negative_rtt_is_rejected(self):
+        clock = ClockSync()
+        self.assertFalse(clock.add_sample(0, 100, 200, 50))
+        self.assertEqual((clock.offset, clock.samples), (None, 0))
+
+    def test_exchange_completes_once(self):
+        clock = ClockSync()
+        self.assertFalse(clock.complete(1030))
+        clock.begin(1000, 1100, 1110)
+        self.assertTrue(clock.complete(1030))
+        self.assertEqual(clock.offset, -90)
+        self.assertFalse(clock.complete(1030))
+        self.assertEqual(clock.samples, 1)
+
+    def test_client_time_must_be_a_finite_number(self):
+        self.assertEqual(client_time_ms(1.5), 1.5)
+        for value in ('1000', None, True, [1000], float('nan'), float('inf')):
+            self.assertIsNone(client_time_ms(value))
+
+    async def heartbeat(self, beat, clock=None):
+        consumer = SyncPlayConsumer()
+        consumer.room_id, consumer.channel_name, consumer.user_id = 'room', 'channel', 'user'
+        consumer.clock = clock or ClockSync()
+        consumer.send_message = mock.AsyncMock()
+        with mock.patch('syncplay.consumers.presence'):
+            await consumer.handle_heartbeat({'type': 'heartbeat', 'data': beat}, 1100)
+        return consumer.send_message.call_args.args[0]['data']
+
+    async def test_heartbeat_ignores_non_numeric_timestamps(self):
+        clock = ClockSync()
+        clock.begin(1000, 1100, 1110)
+        reply = await self.heartbeat({'clientSendTime': 'now', 'lastReceiveTime': {'t': 1}}, clock)
+        self.assertIsNone(reply['clientSendTime'])
+        self.assertEqual(clock.samples, 0)
+        self.assertIsNotNone(clock._pending)
+
+    async def test_heartbeat_begins_and_completes_exchanges(self):
+        clock = ClockSync()
+        clock.begin(1000, 1100, 1110)
+        reply = await self.heartbeat({'clientSendTime': 2000, 'lastReceiveTime': 1030}, clock)
+        self.assertEqual(reply['clientSendTime'], 2000)
+        self.assertEqual(reply['clock']['samples'], 1)
+        self.assertEqual(clock._pending[:2], (2000, 1100))
+
+
+class ControlThrottleTests(SimpleTestCase):
+    def test_bucket_allows_a_burst_then_refills_at_the_rate(self):
+        with mock.patch('syncplay.throttle.time.monotonic', return_value=100.0) as clock:
+            bucket = TokenBucket(rate=2, burst=3)
+            self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+            clock.return_value = 100.5  # One token back
+            self.assertEqual([bucket.consume(), bucket.consume()], [True, False])
+
+            clock.return_value = 200.0  # Refills up to the burst, no further
+            self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+    def test_bucket_without_rate_is_unlimited(self):
+        bucket = TokenBucket(rate=0, burst=1)
+        self.assertTrue(all(bucket.consume() for _ in range(100)))
+
+    def test_unknown_rate_policy_is_rejected(self):
+        with override_settings(SYNCPLAY_CONTROL_RATE_POLICY='close'):
+            self.assertEqual(get_control_rate_policy(), 'close')
+        with override_settings(SYNCPLAY_CONTROL_RATE_POLICY='ignore'):
+            with self.assertRaises(ValueError):
+                get_control_rate_policy()
+
+    def recorder(self, applied, name):
+        async def apply(position):
+            applied.append((name, position))
+        return apply
+
+    async def test_coalescer_applies_the_last_seek_once(self):
+        coalescer, applied = SeekCoalescer(window=0.01), []
+        for position, name in ((1, 'a'), (2, 'b'), (3, 'c')):
+            await coalescer.submit('room', position, self.recorder(applied, name))
+        await coalescer.submit('other', 9, self.recorder(applied, 'd'))
+        await asyncio.sleep(0.05)
+        self.assertEqual(sorted(applied), [('c', 3), ('d', 9)])
+
+    async def test_coalescer_cancel_drops_the_pending_seek(self):
+        coalescer, applied = SeekCoalescer(window=0.01), []
+        await coalescer.submit('room', 1, self.recorder(applied, 'a'))
+        coalescer.cancel('room')
+        await asyncio.sleep(0.05)
+        self.assertEqual(applied, [])
+
+        # The next seek opens a window of its own
+        await coalescer.submit('room', 2, self.recorder(applied, 'b'))
+        await asyncio.sleep(0.05)
+        self.assertEqual(applied, [('b', 2)])
+
+    async def test_coalescer_without_window_applies_each_seek(self):
+        coalescer, applied = SeekCoalescer(window=0), []
+        await coalescer.submit('room', 1, self.recorder(applied, 'a'))
+        await coalescer.submit('room', 2, self.recorder(applied, 'b'))
+        self.assertEqual(applied, [('a', 1), ('b', 2)])
+
+
+class JoinThrottleTests(SimpleTestCase):
+    async def test_batcher_announces_a_window_of_joins_once(self):
+        batcher = JoinBatcher(window=0.01)
+        flushed = []
+
+        async def flush(users):
+            flushed.append(users)
+
+        for user in ('a', 'b', 'c'):
+            await batcher.submit('room', user, flush)
+        await batcher.submit('other', 'd', flush)
+        await asyncio.sleep(0.05)
+        self.assertEqual(sorted(flushed), [['a', 'b', 'c'], ['d']])
+
+        # A new window after the flush
+        await batcher.submit('room', 'e', flush)
+        await asyncio.sleep(0.05)
+        self.assertEqual(flushed[-1], ['e'])
+
+    async def test_batcher_without_window_flushes_each_join(self):
+        flushed = []
+
+        async def flush(users):
+            flushed.append(users)
+
+        await JoinBatcher(window=0).submit('room', 'a', flush)
+        self.assertEqual(flushed, [['a']])
+
+    async def join(self, gate, name, entered, positions, hold):
+        async def on_queued(position):
+            positions[name] = position
+
+        async with gate.slot('room', on_queued):
+            entered.append(name)
+            await hold.wait()
+
+    async def test_gate_admits_waiters_in_order(self):
+        gate, entered, positions = JoinGate(limit=1), [], {}
+        holds = {name: asyncio.Event() for name in 'abcd'}
+        tasks = {}
+        for name in 'abcd':
+            tasks[name] = asyncio.ensure_future(self.join(gate, name, entered, positions, holds[name]))
+            await asyncio.sleep(0)
+        self.assertEqual((entered, positions), (['a'], {'b': 1, 'c': 2, 'd': 3}))
+
+        for name in 'abcd':
+            holds[name].set()
+            await tasks[name]
+        self.assertEqual(entered, ['a', 'b', 'c', 'd'])
+        self.assertEqual(gate._rooms, {})
+
+    async def test_cancelled_waiters_give_up_their_place(self):
+        gate, entered, positions = JoinGate(limit=1), [], {}
+        holds = {name: asyncio.Event() for name in 'abcd'}
+        tasks = {}
+        for name in 'abcd':
+            tasks[name] = asyncio.ensure_future(self.join(gate, name, entered, positions, holds[name]))
+            await asyncio.sleep(0)
+
+        # b gives up while waiting
+        tasks['b'].cancel()
+        await asyncio.sleep(0)
+        # c is handed the slot but cancelled before it resumes: it passes it on
+        holds['a'].set()
+        await asyncio.sleep(0)
+        self.assertTrue(tasks['a'].done())
+        tasks['c'].cancel()
+        await asyncio.sleep(0.01)
+        self.assertEqual(entered, ['a', 'd'])
+
+        holds['d'].set()
+        await tasks['d']
+        for name in 'bc':
+            with self.assertRaises(asyncio.CancelledError):
+                await tasks[name]
+        self.assertEqual(gate._rooms, {})
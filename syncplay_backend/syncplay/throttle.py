@@ -0,0 +1,209 @@
+import asyncio
+import contextlib
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import metrics
+
+RATE_LIMIT_POLICIES = ('drop', 'error', 'close')
+
+
+def get_control_rate_policy():
+    """What happens to control messages over the rate limit: dropped silently,
+    answered with an error, or the connection closed"""
+    policy = getattr(settings, 'SYNCPLAY_CONTROL_RATE_POLICY', 'error')
+    if policy not in RATE_LIMIT_POLICIES:
+        raise ValueError(f"Unknown control rate policy: {policy}")
+    return policy
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    @classmethod
+    def for_control_messages(cls):
+        return cls(
+            getattr(settings, 'SYNCPLAY_CONTROL_RATE', 10.0),
+            getattr(settings, 'SYNCPLAY_CONTROL_BURST', 20),
+        )
+
+    def consume(self, tokens=1):
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class PendingSeek:
+    def __init__(self, position, apply):
+        self.position = position
+        self.apply = apply
+
+
+class SeekCoalescer:
+    """Collapses bursts of seeks in a room into one, last writer wins.
+
+    The first seek in a room opens a window; seeks arriving before it closes
+    only replace the pending position. When the window closes the latest seek
+    is applied once (state update, log entry and broadcast).
+    """
+
+    def __init__(self, window=None):
+        if window is None:
+            window = getattr(settings, 'SYNCPLAY_SEEK_COALESCE_WINDOW', 0.05)
+        self.window = window
+        self._pending = {}
+        self._tasks = set()
+
+    async def submit(self, room_id, position, apply):
+        if self.window <= 0:
+            await apply(position)
+            return
+
+        pending = self._pending.get(room_id)
+        if pending is not None:
+            pending.position = position
+            pending.apply = apply
+            metrics.incr('ws.seeks_coalesced')
+            return
+
+        pending = self._pending[room_id] = PendingSeek(position, apply)
+        asyncio.get_running_loop().call_later(self.window, self._fire, room_id, pending)
+
+    def cancel(self, room_id):
+        """Drop a pending seek, e.g. because a play/pause carries a newer position"""
+        if self._pending.pop(room_id, None) is not None:
+            metrics.incr('ws.seeks_coalesced')
+
+    def _fire(self, room_id, pending):
+        if self._pending.get(room_id) is not pending:
+            return
+        del self._pending[room_id]
+        task = asyncio.ensure_future(pending.apply(pending.position))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+class PendingJoins:
+    def __init__(self, user, flush):
+        self.users = [user]
+        self.flush = flush
+
+
+class JoinBatcher:
+    """Announces the joins of a room in batches instead of one by one.
+
+    The first join in a room opens a window; users joining before it closes
+    are added to the same batch, which is then flushed once. Fan-out stays
+    linear in the room size however many users click the link at once.
+    """
+
+    def __init__(self, window=None):
+        if window is None:
+            window = getattr(settings, 'SYNCPLAY_JOIN_BATCH_WINDOW', 0.1)
+        self.window = window
+        self._pending = {}
+        self._tasks = set()
+
+    async def submit(self, room_id, user, flush):
+        if self.window <= 0:
+            await flush([user])
+            return
+
+        pending = self._pending.get(room_id)
+        if pending is not None:
+            pending.users.append(user)
+            metrics.incr('ws.joins_batched')
+            return
+
+        pending = self._pending[room_id] = PendingJoins(user, flush)
+        asyncio.get_running_loop().call_later(self.window, self._fire, room_id, pending)
+
+    def _fire(self, room_id, pending):
+        if self._pending.get(room_id) is pending:
+            del self._pending[room_id]
+        task = asyncio.ensure_future(pending.flush(pending.users))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+class JoinQueue:
+    def __init__(self):
+        self.active = 0
+        self.waiters = deque()
+
+
+class JoinGate:
+    """Caps the joins of a room being processed at once; the rest wait in order.
+
+    Joins to one room serialise on its row lock anyway, so letting hundreds
+    in at once only ties up database threads.
+    """
+
+    def __init__(self, limit=None):
+        if limit is None:
+            limit = getattr(settings, 'SYNCPLAY_MAX_CONCURRENT_JOINS', 8)
+        self.limit = limit
+        self._rooms = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, room_id, on_queued=None):
+        """Hold a join slot for the room; `on_queued(position)` is awaited if it has to wait"""
+        if not self.limit:
+            yield
+            return
+
+        queue = self._rooms.setdefault(room_id, JoinQueue())
+        if queue.active < self.limit:
+            queue.active += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            queue.waiters.append(waiter)
+            metrics.incr('ws.joins_queued')
+            try:
+                if on_queued:
+                    await on_queued(len(queue.waiters))
+                # _release() hands its slot straight to us
+                await waiter
+            except BaseException:
+                if waiter.done() and not waiter.cancelled():
+                    self._release(room_id)
+                else:
+                    waiter.cancel()
+                    with contextlib.suppress(ValueError):
+                        queue.waiters.remove(waiter)
+                raise
+        try:
+            yield
+        finally:
+            self._release(room_id)
+
+    def _release(self, room_id):
+        queue = self._rooms[room_id]
+        while queue.waiters:
+            waiter = queue.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        queue.active -= 1
+        if not queue.active:
+            del self._rooms[room_id]
+
+
+control_rate_policy = get_control_rate_policy()
+seek_coalescer = SeekCoalescer()
+join_batcher = JoinBatcher()
+join_gate = JoinGate()
@@ -1,16 +1,27 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render
 from rest_framework import status
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
+from django.db.models import Q
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 from datetime import timedelta
 import uuid
 import logging
 
+from . import codec, room_cache
 from .models import Room, User, Message
+from .room_state import room_states
+from .message_log import message_log
+from .metrics import metrics
+from .pagination import (
+    RoomCursorPagination, MESSAGE_PAGE_SIZE, MAX_MESSAGE_PAGE_SIZE, encode_cursor, decode_cursor
+)
 from .serializers import (
-    RoomSerializer, CreateRoomSerializer, JoinRoomSerializer,
+    RoomSerializer, RoomSummarySerializer, CreateRoomSerializer, JoinRoomSerializer,
     VideoControlSerializer, VideoChangeSerializer, RoomStatusSerializer
 )
 
@@ -38,6 +49,7 @@ def create_room(request):
             name=user_name,
             is_host=True
         )
+        room_cache.invalidate()
         
         logger.info(f"Room '{room_name}' created by {user_name}")
         
@@ -92,32 +104,53 @@ def join_room(request):
 @api_view(['GET'])
 def get_room(request, room_id):
     """Get room details"""
-    room = get_object_or_404(Room, id=room_id)
+    entry = room_cache.get_room(room_id)
+    if entry is None:
+        room = get_object_or_404(Room.objects.with_users(), id=room_id)
+        entry = room_cache.set_room(room, RoomSerializer(room).data)
+    
+    if room_cache.not_modified(request, entry):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': entry['etag']})
     
     return Response({
         'status': 'success',
-        'room': RoomSerializer(room).data
-    }, status=status.HTTP_200_OK)
+        'room': room_cache.room_data(entry)
+    }, status=status.HTTP_200_OK, headers={'ETag': entry['etag']})
 
 @api_view(['GET'])
 def list_rooms(request):
-    """List all active rooms"""
-    # Only show rooms with at least one user that was active in the last hour
-    recent_time = timezone.now() - timedelta(hours=1)
-    active_rooms = Room.objects.filter(
-        users__last_seen__gte=recent_time
-    ).distinct().order_by('-created_at')
+    """List active rooms, newest first, one cursor page at a time"""
+    url = request.build_absolute_uri()
+    entry = room_cache.get_lobby(url)
+    if entry is None:
+        # Only show rooms that were active in the last hour
+        recent_time = timezone.now() - timedelta(hours=1)
+        active_rooms = Room.objects.filter(last_active_at__gte=recent_time).with_user_count()
+        
+        paginator = RoomCursorPagination()
+        page = paginator.paginate_queryset(active_rooms, request)
+        rooms_data = RoomSummarySerializer(page, many=True).data
+        entry = room_cache.set_lobby(url, {
+            'status': 'success',
+            'rooms': rooms_data,
+            'count': len(rooms_data),
+            'next': paginator.get_next_link(),
+            'previous': paginator.get_previous_link()
+        })
     
-    rooms_data = []
-    for room in active_rooms:
-        room_data = RoomSerializer(room).data
-        rooms_data.append(room_data)
+    if room_cache.not_modified(request, entry):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': entry['etag']})
     
+    return Response(entry['data'], status=status.HTTP_200_OK, headers={'ETag': entry['etag']})
+
+def version_conflict(room):
+    """The room changed since the db_version the client sent; it should rebase"""
+    room.refresh_from_db()
     return Response({
-        'status': 'success',
-        'rooms': rooms_data,
-        'count': len(rooms_data)
-    }, status=status.HTTP_200_OK)
+        'status': 'error',
+        'message': 'Room was modified by someone else',
+        'room': RoomSerializer(room).data
+    }, status=status.HTTP_409_CONFLICT)
 
 @api_view(['POST'])
 def control_video(request, room_id):
@@ -145,21 +178,19 @@ def control_video(request, room_id):
         position = serializer.validated_data['position']
         
         # Update room state
+        fields = {
+            'current_position': timedelta(seconds=position),
+            'position_updated_at': timezone.now(),
+        }
         if action in ['play', 'pause']:
-            room.is_playing = (action == 'play')
-            room.current_position = timedelta(seconds=position)
-            room.save()
-        elif action == 'seek':
-            room.current_position = timedelta(seconds=position)
-            room.save()
+            fields['is_playing'] = (action == 'play')
+        if not room.versioned_update(serializer.validated_data.get('db_version'), **fields):
+            return version_conflict(room)
+        room_states.refresh(room)
+        room_cache.invalidate(room.id)
         
         # Store message
-        Message.objects.create(
-            room=room,
-            user_id=user_id,
-            message_type=action,
-            data={'position': position}
-        )
+        message_log.log(room.id, user_id, action, {'position': position})
         
         logger.info(f"Video {action} by {user.name} in room {room.name}")
         
@@ -200,22 +231,24 @@ def change_video(request, room_id):
         video_title = serializer.validated_data['video_title']
         
         # Update room
-        room.current_video_url = video_url
-        room.current_video_title = video_title
-        room.current_position = timedelta(0)
-        room.is_playing = False
-        room.save()
+        updated = room.versioned_update(
+            serializer.validated_data.get('db_version'),
+            current_video_url=video_url,
+            current_video_title=video_title,
+            current_position=timedelta(0),
+            position_updated_at=timezone.now(),
+            is_playing=False,
+        )
+        if not updated:
+            return version_conflict(room)
+        room_states.refresh(room)
+        room_cache.invalidate(room.id)
         
         # Store message
-        Message.objects.create(
-            room=room,
-            user_id=user_id,
-            message_type='video_changed',
-            data={
-                'videoUrl': video_url,
-                'videoTitle': video_title
-            }
-        )
+        message_log.log(room.id, user_id, 'video_changed', {
+            'videoUrl': video_url,
+            'videoTitle': video_title
+        })
         
         logger.info(f"Video changed to '{video_title}' by {user.name} in room {room.name}")
         
@@ -230,28 +263,106 @@ def change_video(request, room_id):
         'errors': serializer.errors
     }, status=status.HTTP_400_BAD_REQUEST)
 
+MESSAGE_FIELDS = ('id', 'user_id', 'message_type', 'data', 'timestamp')
+EXPORT_BATCH_SIZE = 2000
+
+def message_data(message):
+    return {
+        'id': str(message['id']),
+        'user_id': str(message['user_id']),
+        'type': message['message_type'],
+        'data': message['data'],
+        'timestamp': message['timestamp'].isoformat()
+    }
+
+def message_cursor(message):
+    return encode_cursor(message['timestamp'], message['id'])
+
+# Keyset conditions on (timestamp, id), served by the room history index
+def messages_before(messages, timestamp, pk):
+    return messages.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+
+def messages_after(messages, timestamp, pk):
+    return messages.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
+
+def message_page(messages, limit, forward=False):
+    """One page of `messages` as values, plus one extra row to tell whether there are more.
+
+    Newest first unless `forward`; both orders walk syncplay_msg_room_ts_idx.
+    """
+    order = ('timestamp', 'id') if forward else ('-timestamp', '-id')
+    return messages.order_by(*order).values(*MESSAGE_FIELDS)[:limit + 1]
+
+async def export_messages(messages):
+    """NDJSON for `messages`, oldest first, fetched one keyset batch at a time.
+
+    An async generator so ASGI servers stream it; Django would read a sync
+    iterator into memory in one go before sending anything.
+    """
+    ordered = messages.order_by('timestamp', 'id').values(*MESSAGE_FIELDS)
+    fetch = sync_to_async(lambda queryset: list(queryset[:EXPORT_BATCH_SIZE]))
+    batch = await fetch(ordered)
+    while batch:
+        yield ''.join(codec.dumps(message_data(row)) + '\n' for row in batch)
+        if len(batch) < EXPORT_BATCH_SIZE:
+            break
+        last = batch[-1]
+        batch = await fetch(messages_after(ordered, last['timestamp'], last['id']))
+
 @api_view(['GET'])
 def get_room_messages(request, room_id):
-    """Get recent messages for a room"""
+    """Get a page of a room's messages in chronological order.
+    
+    Returns the latest `limit` messages unless `before` or `after` holds a
+    cursor from a previous page. `type` filters by message type and
+    `export=ndjson` streams every matching message instead of a page.
+    """
     room = get_object_or_404(Room, id=room_id)
+    messages = Message.objects.filter(room=room)
     
-    # Get last 50 messages
-    messages = Message.objects.filter(room=room).order_by('-timestamp')[:50]
+    types = [t for value in request.query_params.getlist('type') for t in value.split(',') if t]
+    if types:
+        messages = messages.filter(message_type__in=types)
     
-    messages_data = []
-    for message in messages:
-        messages_data.append({
-            'id': str(message.id),
-            'user_id': str(message.user_id),
-            'type': message.message_type,
-            'data': message.data,
-            'timestamp': message.timestamp.isoformat()
-        })
+    try:
+        limit = int(request.query_params.get('limit', MESSAGE_PAGE_SIZE))
+        before = request.query_params.get('before')
+        before = decode_cursor(before) if before else None
+        after = request.query_params.get('after')
+        after = decode_cursor(after) if after else None
+        if not 0 < limit <= MAX_MESSAGE_PAGE_SIZE:
+            raise ValueError(limit)
+    except ValueError:
+        return Response({
+            'status': 'error',
+            'message': f'Invalid cursor or limit (1-{MAX_MESSAGE_PAGE_SIZE})'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    if before:
+        messages = messages_before(messages, *before)
+    if after:
+        messages = messages_after(messages, *after)
+    
+    if request.query_params.get('export') == 'ndjson':
+        return StreamingHttpResponse(export_messages(messages), content_type='application/x-ndjson')
+    
+    if after and not before:
+        # Paging forward: oldest messages after the cursor
+        page = list(message_page(messages, limit, forward=True))
+        has_more = len(page) > limit
+        page = page[:limit]
+    else:
+        page = list(message_page(messages, limit))
+        has_more = len(page) > limit
+        page = page[:limit][::-1]  # Return chronological order
     
     return Response({
         'status': 'success',
-        'messages': list(reversed(messages_data)),  # Return chronological order
-        'count': len(messages_data)
+        'messages': [message_data(message) for message in page],
+        'count': len(page),
+        'has_more': has_more,
+        'before': message_cursor(page[0]) if page else request.query_params.get('before'),
+        'after': message_cursor(page[-1]) if page else request.query_params.get('after')
     }, status=status.HTTP_200_OK)
 
 @api_view(['DELETE'])
@@ -269,15 +380,11 @@ def leave_room(request, room_id):
     user = get_object_or_404(User, id=user_id, room=room)
     
     # Store leave message
-    Message.objects.create(
-        room=room,
-        user_id=user_id,
-        message_type='leave',
-        data={}
-    )
+    message_log.log(room.id, user_id, 'leave', {})
     
     user_name = user.name
     user.delete()
+    room_cache.invalidate(room.id)
     
     logger.info(f"User {user_name} left room {room.name}")
     
@@ -298,3 +405,15 @@ def health_check(request):
         'timestamp': timezone.now().isoformat(),
         'version': '1.0.0'
     }, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def metrics_view(request):
+    """Process-level counters (compression savings, ...); staff only"""
+    counters = metrics.snapshot()
+    saved = counters.get('ws.compression.bytes_in', 0) - counters.get('ws.compression.bytes_out', 0)
+    return Response({
+        'status': 'success',
+        'metrics': counters,
+        'compression_bytes_saved': saved,
+    }, status=status.HTTP_200_OK)
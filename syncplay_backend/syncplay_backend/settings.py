@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 
 from pathlib import Path
 import os
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -108,9 +109,20 @@ DATABASES = {
  #       'PASSWORD': os.getenv('DB_PASSWORD', ''),
   #      'HOST': os.getenv('DB_HOST', 'localhost'),
    #     'PORT': os.getenv('DB_PORT', '5432'),
+        # 0 closes connections after every request. Under ASGI each request
+        # runs in a new thread, so persistent connections would never be
+        # reused and only pile up; the consumers' database threads keep
+        # theirs open for SYNCPLAY_DB_CONN_MAX_AGE instead
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '0')),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Behind pgbouncer in transaction pooling mode server-side cursors (used by
+# .iterator()) do not survive between transactions
+if os.getenv('DB_PGBOUNCER', 'False').lower() == 'true':
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -163,7 +175,12 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.AllowAny',
     ],
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'syncplay.renderers.FastJSONRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'syncplay.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
@@ -213,6 +230,125 @@ if DEBUG:
         },
     }
 
+# SyncPlay runtime tuning
+# JSON codec for WebSocket frames and REST bodies: 'auto' uses orjson or
+# msgspec when installed and falls back to the stdlib, or force one by name
+SYNCPLAY_JSON_CODEC = os.getenv('SYNCPLAY_JSON_CODEC', 'auto')
+
+# Threads running the WebSocket consumers' database calls; each holds at
+# most one connection, so this bounds the connections per worker process
+SYNCPLAY_DB_THREADS = int(os.getenv('SYNCPLAY_DB_THREADS', '8'))
+# Seconds those threads reuse a connection (checked before reuse when
+# CONN_HEALTH_CHECKS is on); 0 closes it after every call
+SYNCPLAY_DB_CONN_MAX_AGE = int(os.getenv('SYNCPLAY_DB_CONN_MAX_AGE', '60'))
+
+# How the consumer reaches the database: 'pool' (the threads above) or
+# 'async_orm' (Django's async ORM methods, which Django 5.0 still runs in a
+# shared thread, so only worth it once Django has native async backends)
+SYNCPLAY_DB_ACCESS = os.getenv('SYNCPLAY_DB_ACCESS', 'pool')
+
+# Seconds between write-behind flushes of in-memory room playback state
+SYNCPLAY_STATE_FLUSH_INTERVAL = float(os.getenv('SYNCPLAY_STATE_FLUSH_INTERVAL', '1.0'))
+
+# Batched audit log: queue bound, rows per INSERT, seconds between flushes and
+# what to drop when the queue is full ('drop_oldest' or 'drop_newest')
+SYNCPLAY_MESSAGE_LOG_MAX_SIZE = int(os.getenv('SYNCPLAY_MESSAGE_LOG_MAX_SIZE', '10000'))
+SYNCPLAY_MESSAGE_LOG_BATCH_SIZE = int(os.getenv('SYNCPLAY_MESSAGE_LOG_BATCH_SIZE', '500'))
+SYNCPLAY_MESSAGE_LOG_FLUSH_INTERVAL = float(os.getenv('SYNCPLAY_MESSAGE_LOG_FLUSH_INTERVAL', '1.0'))
+SYNCPLAY_MESSAGE_LOG_POLICY = os.getenv('SYNCPLAY_MESSAGE_LOG_POLICY', 'drop_oldest')
+
+# Days messages are kept before archive_messages moves them to gzipped NDJSON
+# files in SYNCPLAY_MESSAGE_ARCHIVE_DIR (empty: delete without archiving).
+# SYNCPLAY_MESSAGE_RETENTION overrides it per type, e.g. "seek=1,join=30".
+SYNCPLAY_MESSAGE_RETENTION_DAYS = float(os.getenv('SYNCPLAY_MESSAGE_RETENTION_DAYS', '30'))
+
+
+def parse_message_retention(value):
+    retention = {}
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        message_type, _, days = item.partition('=')
+        try:
+            retention[message_type.strip()] = float(days)
+        except ValueError:
+            raise ImproperlyConfigured(
+                f"SYNCPLAY_MESSAGE_RETENTION entries must look like type=days, got {item!r}"
+            ) from None
+        if not message_type.strip():
+            raise ImproperlyConfigured(f"SYNCPLAY_MESSAGE_RETENTION entry {item!r} has no message type")
+    return retention
+
+
+SYNCPLAY_MESSAGE_RETENTION = parse_message_retention(os.getenv('SYNCPLAY_MESSAGE_RETENTION', 'seek=1,heartbeat=1'))
+SYNCPLAY_MESSAGE_ARCHIVE_DIR = os.getenv('SYNCPLAY_MESSAGE_ARCHIVE_DIR', str(BASE_DIR / 'archive'))
+
+# Milliseconds ahead of the server time at which play/pause/seek broadcasts ask
+# clients to execute (0 sends only the server timestamp)
+SYNCPLAY_SCHEDULE_LEAD_MS = int(os.getenv('SYNCPLAY_SCHEDULE_LEAD_MS', '0'))
+
+# Frames at least this many bytes are deflated for clients that negotiated a
+# '.deflate' subprotocol (0 disables compression)
+SYNCPLAY_COMPRESSION_THRESHOLD = int(os.getenv('SYNCPLAY_COMPRESSION_THRESHOLD', '1024'))
+SYNCPLAY_COMPRESSION_LEVEL = int(os.getenv('SYNCPLAY_COMPRESSION_LEVEL', '6'))
+
+# Control messages (play/pause/seek/video_changed) allowed per connection: a
+# token bucket refilled at RATE per second holding up to BURST tokens (RATE 0
+# disables). POLICY for excess messages: 'drop', 'error' or 'close'.
+SYNCPLAY_CONTROL_RATE = float(os.getenv('SYNCPLAY_CONTROL_RATE', '10'))
+SYNCPLAY_CONTROL_BURST = int(os.getenv('SYNCPLAY_CONTROL_BURST', '20'))
+SYNCPLAY_CONTROL_RATE_POLICY = os.getenv('SYNCPLAY_CONTROL_RATE_POLICY', 'error')
+
+# Seeks in a room within this many seconds collapse into the last one (0 disables)
+SYNCPLAY_SEEK_COALESCE_WINDOW = float(os.getenv('SYNCPLAY_SEEK_COALESCE_WINDOW', '0.05'))
+
+# Joins in a room within this many seconds are announced in one users_joined
+# broadcast (0 announces each join). At most SYNCPLAY_MAX_CONCURRENT_JOINS joins
+# per room are processed at once; the rest queue and are told their position.
+SYNCPLAY_JOIN_BATCH_WINDOW = float(os.getenv('SYNCPLAY_JOIN_BATCH_WINDOW', '0.1'))
+SYNCPLAY_MAX_CONCURRENT_JOINS = int(os.getenv('SYNCPLAY_MAX_CONCURRENT_JOINS', '8'))
+
+# Heartbeats are tracked in memory and written to RoomSession.last_activity
+# every sweep. With a Redis URL liveness is also shared across processes.
+SYNCPLAY_PRESENCE_SWEEP_INTERVAL = float(os.getenv('SYNCPLAY_PRESENCE_SWEEP_INTERVAL', '30'))
+SYNCPLAY_REDIS_URL = os.getenv('SYNCPLAY_REDIS_URL')
+
+# Where room playback state lives: 'memory' (one process per room) or 'redis'
+# (shared by every ASGI worker, requires SYNCPLAY_REDIS_URL). Redis copies of
+# rooms nobody is connected to expire after SYNCPLAY_ROOM_STATE_TTL seconds.
+SYNCPLAY_ROOM_STATE_BACKEND = os.getenv('SYNCPLAY_ROOM_STATE_BACKEND', 'memory')
+SYNCPLAY_ROOM_STATE_TTL = int(os.getenv('SYNCPLAY_ROOM_STATE_TTL', '3600'))
+
+# Cached room summaries for GET /rooms/ and /rooms/<id>/, invalidated on writes.
+# Without Redis the cache is per process, so other workers may serve a room
+# up to SYNCPLAY_ROOM_CACHE_TTL seconds old. Lobby pages always expire after
+# SYNCPLAY_LOBBY_CACHE_TTL seconds as rooms age out of the activity window.
+SYNCPLAY_ROOM_CACHE_TTL = int(os.getenv('SYNCPLAY_ROOM_CACHE_TTL', '60'))
+SYNCPLAY_LOBBY_CACHE_TTL = int(os.getenv('SYNCPLAY_LOBBY_CACHE_TTL', '5'))
+
+# python -m syncplay.serve: worker processes (0: one per CPU, or 1 while room
+# state or the channel layer is in memory), listen backlog
+# per worker socket, idle seconds before TCP keepalive probes (0 disables),
+# WebSocket ping interval/timeout and how long shutdown waits for connections
+SYNCPLAY_WORKERS = int(os.getenv('SYNCPLAY_WORKERS', '0'))
+SYNCPLAY_LISTEN_BACKLOG = int(os.getenv('SYNCPLAY_LISTEN_BACKLOG', '2048'))
+SYNCPLAY_TCP_KEEPALIVE = int(os.getenv('SYNCPLAY_TCP_KEEPALIVE', '60'))
+SYNCPLAY_WS_PING_INTERVAL = float(os.getenv('SYNCPLAY_WS_PING_INTERVAL', '20'))
+SYNCPLAY_WS_PING_TIMEOUT = float(os.getenv('SYNCPLAY_WS_PING_TIMEOUT', '30'))
+SYNCPLAY_DRAIN_TIMEOUT = float(os.getenv('SYNCPLAY_DRAIN_TIMEOUT', '30'))
+
+if SYNCPLAY_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': SYNCPLAY_REDIS_URL,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
 # Logging configuration
 LOGGING = {
     'version': 1,